@@ -1,4 +1,4 @@
-from fastembed.embedding import FlagEmbedding as Embedding
-
-embedding_model = Embedding(model_name="BAAI/bge-small-en-v1.5", max_length=512)
+from src.embeddings import get_embedding_model
 
+# Download the model before the API starts, so its warmup does not have to
+get_embedding_model()
@@ -0,0 +1,57 @@
+import re
+from typing import List, NamedTuple
+
+# Spans starting or ending with one of these words are not looked up
+STOPWORDS = {
+    "a", "about", "after", "against", "all", "also", "an", "and", "any", "are", "as", "at", "be", "been", "before",
+    "being", "between", "both", "but", "by", "can", "could", "did", "do", "does", "during", "each", "either", "for",
+    "from", "had", "has", "have", "having", "he", "her", "here", "his", "how", "however", "i", "if", "in", "into",
+    "is", "it", "its", "may", "might", "more", "most", "much", "must", "no", "nor", "not", "of", "on", "or", "other",
+    "our", "over", "she", "should", "such", "than", "that", "the", "their", "them", "then", "there", "these", "they",
+    "this", "those", "through", "thus", "to", "under", "up", "upon", "via", "was", "we", "were", "what", "when",
+    "where", "whether", "which", "while", "who", "whom", "why", "will", "with", "within", "without", "would", "yet",
+}
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-'/.]\w+)*")
+
+
+class Span(NamedTuple):
+    """Substring of the text, with the character offsets of its first character and after its last character."""
+
+    start: int
+    end: int
+    text: str
+
+
+def candidate_spans(text: str, max_ngram: int = 5, min_length: int = 3) -> List[Span]:
+    """Generate the token n-grams of the text, up to `max_ngram` tokens.
+
+    N-grams starting or ending with a stopword, only made of digits, or shorter than `min_length` characters are
+    pruned, the text of a span is the original text between its first and last token.
+    """
+    tokens = [(match.start(), match.end(), match.group().lower()) for match in TOKEN_PATTERN.finditer(text)]
+    spans = []
+    for i, (start, _, first) in enumerate(tokens):
+        if first in STOPWORDS:
+            continue
+        for end_token in tokens[i : i + max_ngram]:
+            _, end, last = end_token
+            if last in STOPWORDS or end - start < min_length:
+                continue
+            span_text = text[start:end]
+            if span_text.replace(" ", "").isdigit():
+                continue
+            spans.append(Span(start, end, span_text))
+    return spans
+
+
+def select_non_overlapping(annotations: List[dict]) -> List[dict]:
+    """Keep the best scored annotations that do not overlap with a better one, preferring longer spans on ties.
+
+    Annotations need a `start`, `end` and `score`, they are returned in the order of the text.
+    """
+    selected: List[dict] = []
+    for annotation in sorted(annotations, key=lambda a: (-a["score"], -(a["end"] - a["start"]), a["start"])):
+        if all(annotation["end"] <= other["start"] or annotation["start"] >= other["end"] for other in selected):
+            selected.append(annotation)
+    return sorted(selected, key=lambda a: a["start"])
@@ -1,13 +1,78 @@
-from fastapi import FastAPI, File, UploadFile, Form, Depends, HTTPException, Body, Query
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel, conint
-from typing import Dict, List, Union, Annotated
+import time
+
+# Time of the import of the API, to measure how long it takes to be ready to serve requests
+import_time = time.perf_counter()
+
+import asyncio
+import os
+from collections import Counter
+
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, File, UploadFile, Form, Depends, HTTPException, Body, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, conint
+from typing import Dict, List, Literal, Union, Annotated
 from starlette.middleware.cors import CORSMiddleware
-from fastembed.embedding import FlagEmbedding as Embedding
-from qdrant_client import QdrantClient
+from src.annotate import candidate_spans, select_non_overlapping
+from src.backends import CLIQUE_FIELDS, Hit, SearchFilters, VectorQuery, backend_from_env, fuse_hits
+from src.batching import EmbeddingBatcher
+from src.embedding_cache import cache_from_env, normalize_string
+from src.embeddings import (
+    EMBEDDING_MODEL,
+    EMBEDDING_SIZE,
+    RERANK_EMBEDDING_MODEL,
+    RERANK_EMBEDDING_SIZE,
+    embed,
+    embed_rerank,
+    get_embedding_model,
+    warmup as warmup_model,
+)
+from src.metrics import (
+    EMBEDDING_CACHE_HITS,
+    EMBEDDING_CACHE_MISSES,
+    QUERIES_PER_REQUEST,
+    RESULTS_PER_QUERY,
+    MetricsMiddleware,
+    render_metrics,
+    timed,
+)
+from src.jobs import JobStore
+from src.prefix_index import PrefixIndex
+
+
+# State of the startup warmup, reported by /ready
+startup = {
+    "ready": False,
+    "model": EMBEDDING_MODEL,
+    "rerank_model": RERANK_EMBEDDING_MODEL,
+    "model_load_s": None,
+    "warmup_s": None,
+    "import_to_ready_s": None,
+    "backend_error": None,
+}
+startup_tasks = set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("WARMUP", "true").lower() == "true":
+        # Warm up in the background, the server answers /health meanwhile, and /ready once warm
+        task = asyncio.create_task(warmup())
+        startup_tasks.add(task)
+        task.add_done_callback(startup_tasks.discard)
+    else:
+        # The model is loaded by the first request
+        startup["ready"] = True
+    jobs.start()
+    yield
+    await jobs.stop()
 
 
 app = FastAPI(
+    lifespan=lifespan,
     title="Concept resolver",
     description="""This service takes lexical strings and attempts to map them to identifiers
     (CURIEs) from a vocabulary or ontology.  The lookup is not exact, but includes partial matches.<p/>
@@ -23,21 +88,90 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Count and time the requests, and report the time of their stages in the Server-Timing header
+app.add_middleware(MetricsMiddleware)
 
-# Initialize FastEmbed and Qdrant Client
-embedding_model = Embedding(model_name="BAAI/bge-small-en-v1.5", max_length=512)
-embedding_size = 384
+# Cache of query embeddings, most lookups are for strings that have already been resolved
+embedding_cache = cache_from_env(EMBEDDING_MODEL)
+EMBEDDING_CACHE_HITS.set_function(lambda: embedding_cache.hits)
+EMBEDDING_CACHE_MISSES.set_function(lambda: embedding_cache.misses)
 
-vectordb = QdrantClient(
-    host="qdrant",
-    prefer_grpc=True,
+# Run the embedding model outside of the event loop, and group the strings of concurrent requests in one batch
+embedding_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("EMBEDDING_WORKERS", "1")), thread_name_prefix="embedding"
+)
+embedding_batcher = EmbeddingBatcher(
+    embed,
+    embedding_executor,
+    max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+    max_wait=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000,
 )
 
+# Vector store of the synonyms, Qdrant by default, configured with the VECTOR_BACKEND env variable
+backend = backend_from_env()
+
+# Search the centroids of the concepts before their synonyms by default
+two_stage_default = os.getenv("LOOKUP_TWO_STAGE", "false").lower() == "true"
+# Number of candidate concepts reranked with the vectors of the rerank model by default
+rerank_candidates_default = int(os.getenv("RERANK_CANDIDATES", "50"))
+
+# Labels prefix index built by babel_load.py, used to answer autocomplete lookups without embedding the string
+prefix_index = PrefixIndex.open(os.getenv("PREFIX_INDEX_PATH", "data/prefix_index"))
+# Shorter autocomplete strings are only completed with the prefix index, longer ones are also searched by vector
+autocomplete_vector_min_length = int(os.getenv("AUTOCOMPLETE_VECTOR_MIN_LENGTH", "5"))
+
 
 class LookupResult(BaseModel):
     curie:str
+    label: Union[str, None] = Field(None, description="Only returned when selected in `fields`.")
+    synonyms: Union[List[str], None] = Field(None, description="Only returned when selected in `fields`.")
+    types: Union[List[str], None] = Field(None, description="Only returned when selected in `fields`.")
+    score: float
+
+
+class LookupQuery(BaseModel):
+    string: str = Field(description="The string to search for.")
+    autocomplete: bool = Field(
+        False,
+        description="Is the input string incomplete (autocomplete=true) or a complete phrase (autocomplete=false)?",
+    )
+    offset: int = Field(0, ge=0, description="The number of results to skip.")
+    limit: int = Field(10, ge=0, le=1000, description="The number of results to return.")
+    biolink_type: Union[str, None] = Field(None, description="The Biolink type to filter to, e.g. `biolink:Disease`.")
+    only_prefixes: Union[str, None] = Field(None, description="Pipe-separated list of prefixes to filter to, e.g. `MONDO|EFO`.")
+    exclude_prefixes: Union[str, None] = Field(None, description="Pipe-separated list of prefixes to exclude, e.g. `UMLS|EFO`.")
+    two_stage: bool = Field(
+        two_stage_default,
+        description="Search the concepts centroids first, then rescore the synonyms of the best concepts only.",
+    )
+    rerank: bool = Field(
+        False,
+        description="Retrieve candidates with the fast model, then rank them with the vectors of the rerank model.",
+    )
+    rerank_candidates: int = Field(
+        rerank_candidates_default, ge=1, le=1000, description="Number of candidate concepts reranked."
+    )
+    fields: Union[str, None] = Field(
+        None, description="Pipe-separated list of the fields of the results to return, e.g. `label|types`."
+    )
+    include_synonyms: bool = Field(True, description="Return the synonyms of the results.")
+
+
+class AnnotateRequest(BaseModel):
+    text: str = Field(description="The text to annotate.")
+    max_ngram: int = Field(5, ge=1, le=10, description="Maximum number of tokens of the spans looked up.")
+    min_score: float = Field(0.8, ge=0, le=1, description="Minimum similarity score of the annotations.")
+    biolink_type: Union[str, None] = Field(None, description="The Biolink type to filter to, e.g. `biolink:Disease`.")
+    only_prefixes: Union[str, None] = Field(None, description="Pipe-separated list of prefixes to filter to, e.g. `MONDO|EFO`.")
+    exclude_prefixes: Union[str, None] = Field(None, description="Pipe-separated list of prefixes to exclude, e.g. `UMLS|EFO`.")
+
+
+class Annotation(BaseModel):
+    start: int = Field(description="Offset of the first character of the span in the text.")
+    end: int = Field(description="Offset after the last character of the span in the text.")
+    text: str
+    curie: str
     label: str
-    synonyms: List[str]
     types: List[str]
     score: float
 
@@ -54,9 +188,9 @@ async def lookup_curies_get(
     autocomplete: Annotated[
         bool,
         Query(
-            description="Is the input string incomplete (autocomplete=true) or a complete phrase (autocomplete=false)?"
+            description="Is the input string incomplete (autocomplete=true) or a complete phrase (autocomplete=false)? Incomplete strings are completed with the labels starting with them."
         ),
-    ] = True,
+    ] = False,
     offset: Annotated[
         int,
         Query(
@@ -98,11 +232,37 @@ async def lookup_curies_get(
             # example="UMLS|EFO"
         ),
     ] = None,
-) -> list[LookupResult]:
+    two_stage: Annotated[
+        bool,
+        Query(
+            description="Search the concepts centroids first, then rescore the synonyms of the best concepts only.",
+        ),
+    ] = two_stage_default,
+    rerank: Annotated[
+        bool,
+        Query(
+            description="Retrieve candidates with the fast model, then rank them with the vectors of the rerank model, more accurate but slower.",
+        ),
+    ] = False,
+    rerank_candidates: Annotated[
+        int,
+        Query(description="Number of candidate concepts reranked, more is more accurate but slower.", ge=1, le=1000),
+    ] = rerank_candidates_default,
+    fields: Annotated[
+        Union[str, None],
+        Query(
+            description="Pipe-separated list of the fields of the results to return in addition to the `curie` and `score`, e.g. `label|types`. All the fields by default.",
+        ),
+    ] = None,
+    include_synonyms: Annotated[
+        bool,
+        Query(description="Return the synonyms of the results, which are most of the size of the response."),
+    ] = True,
+) -> Response:
     """
     Returns cliques with a name or synonym that contains a specified string.
     """
-    return await lookup(
+    results = await lookup(
         string,
         autocomplete,
         offset,
@@ -110,7 +270,13 @@ async def lookup_curies_get(
         biolink_type,
         only_prefixes,
         exclude_prefixes,
+        two_stage,
+        result_fields(fields, include_synonyms),
+        check_rerank(rerank),
+        rerank_candidates,
     )
+    RESULTS_PER_QUERY.observe(len(results), endpoint="/lookup")
+    return json_response(results)
 
 
 @app.post(
@@ -125,9 +291,9 @@ async def lookup_curies_post(
     autocomplete: Annotated[
         bool,
         Query(
-            description="Is the input string incomplete (autocomplete=true) or a complete phrase (autocomplete=false)?"
+            description="Is the input string incomplete (autocomplete=true) or a complete phrase (autocomplete=false)? Incomplete strings are completed with the labels starting with them."
         ),
-    ] = True,
+    ] = False,
     offset: Annotated[
         int,
         Query(
@@ -169,11 +335,37 @@ async def lookup_curies_post(
             # example="UMLS|EFO"
         ),
     ] = None,
-) -> list[LookupResult]:
+    two_stage: Annotated[
+        bool,
+        Query(
+            description="Search the concepts centroids first, then rescore the synonyms of the best concepts only.",
+        ),
+    ] = two_stage_default,
+    rerank: Annotated[
+        bool,
+        Query(
+            description="Retrieve candidates with the fast model, then rank them with the vectors of the rerank model, more accurate but slower.",
+        ),
+    ] = False,
+    rerank_candidates: Annotated[
+        int,
+        Query(description="Number of candidate concepts reranked, more is more accurate but slower.", ge=1, le=1000),
+    ] = rerank_candidates_default,
+    fields: Annotated[
+        Union[str, None],
+        Query(
+            description="Pipe-separated list of the fields of the results to return in addition to the `curie` and `score`, e.g. `label|types`. All the fields by default.",
+        ),
+    ] = None,
+    include_synonyms: Annotated[
+        bool,
+        Query(description="Return the synonyms of the results, which are most of the size of the response."),
+    ] = True,
+) -> Response:
     """
     Returns cliques with a name or synonym that contains a specified string.
     """
-    return await lookup(
+    results = await lookup(
         string,
         autocomplete,
         offset,
@@ -181,7 +373,13 @@ async def lookup_curies_post(
         biolink_type,
         only_prefixes,
         exclude_prefixes,
+        two_stage,
+        result_fields(fields, include_synonyms),
+        check_rerank(rerank),
+        rerank_candidates,
     )
+    RESULTS_PER_QUERY.observe(len(results), endpoint="/lookup")
+    return json_response(results)
 
 
 async def lookup(
@@ -192,29 +390,436 @@ async def lookup(
     biolink_type: str = None,
     only_prefixes: str = "",
     exclude_prefixes: str = "",
+    two_stage: bool = two_stage_default,
+    fields: List[str] = CLIQUE_FIELDS,
+    rerank: bool = False,
+    rerank_candidates: int = rerank_candidates_default,
 ) -> list[LookupResult]:
-    query_embeddings = list(embedding_model.embed([string]))[0]
+    filters = build_filters(biolink_type, only_prefixes, exclude_prefixes)
+    if autocomplete and prefix_index is not None:
+        vector_hits = None
+        if len(string.strip()) >= autocomplete_vector_min_length:
+            vector_hits = await search_vectors(
+                string, 0, offset + limit, filters, two_stage, rerank, rerank_candidates
+            )
+        hits = autocomplete_hits(string, offset, limit, filters, vector_hits)
+    else:
+        hits = await search_vectors(string, offset, limit, filters, two_stage, rerank, rerank_candidates)
+    return (await hydrate_hits([hits], [fields]))[0]
+
+
+def autocomplete_hits(
+    string: str, offset: int, limit: int, filters: Union[SearchFilters, None], vector_hits: Union[List[Hit], None]
+) -> List[Hit]:
+    """Complete the labels starting with the string, merged with the vector hits of the longer strings.
+
+    The vector hits come first, so the concepts found by both keep their cosine similarity as score.
+    """
+    with timed("prefix"):
+        hits = prefix_index.search(string, offset + limit, filters)
+    if vector_hits is not None:
+        hits = fuse_hits([vector_hits, hits])
+    return hits[offset : offset + limit]
+
 
-    hits = vectordb.search(
-        collection_name="concept-resolver",
-        query_vector=query_embeddings,
-        limit=limit,
+async def search_vectors(
+    string: str,
+    offset: int,
+    limit: int,
+    filters: Union[SearchFilters, None],
+    two_stage: bool,
+    rerank: bool = False,
+    rerank_candidates: int = rerank_candidates_default,
+) -> List[Hit]:
+    query_embeddings = (await embed_strings([string]))[0]
+    query = VectorQuery(query_embeddings, limit=limit, offset=offset, filters=filters)
+    if rerank:
+        rerank_embeddings = await embed_rerank_strings([string])
+        hits = await backend.search_cascade([query], rerank_embeddings, [rerank_candidates], two_stage)
+    else:
+        hits = await (backend.search_two_stage([query]) if two_stage else backend.search([query]))
+    return hits[0]
+
+
+@app.post(
+    "/bulk-lookup",
+    summary="Look up cliques for a list of names or synonyms in one request.",
+    description="""Embeds all the strings in one batch and runs all the searches in one request to the vector database.
+    Returns a dictionary with the results of each query keyed by its string, so each string can only be queried once.""",
+    response_model=Dict[str, List[LookupResult]],
+    tags=["lookup"],
+)
+async def bulk_lookup(
+    queries: Annotated[List[LookupQuery], Body(description="The list of queries to resolve.")],
+) -> Response:
+    """
+    Returns cliques for each of the queried strings.
+    """
+    QUERIES_PER_REQUEST.observe(len(queries), endpoint="/bulk-lookup")
+    if not queries:
+        return json_response({})
+    # Results are keyed by string, the results of a repeated string would overwrite each other
+    duplicates = [string for string, count in Counter(query.string for query in queries).items() if count > 1]
+    if duplicates:
+        raise HTTPException(status_code=400, detail=f"Strings queried more than once: {duplicates}")
+    fields_lists = [result_fields(query.fields, query.include_synonyms) for query in queries]
+    for query in queries:
+        check_rerank(query.rerank)
+    filters_list = [
+        build_filters(query.biolink_type, query.only_prefixes, query.exclude_prefixes) for query in queries
+    ]
+    completed = [query.autocomplete and prefix_index is not None for query in queries]
+    # Short strings to autocomplete are only completed from the prefix index, they are not embedded nor searched
+    searched = [
+        i
+        for i, query in enumerate(queries)
+        if not completed[i] or len(query.string.strip()) >= autocomplete_vector_min_length
+    ]
+    query_embeddings = await embed_strings([queries[i].string for i in searched]) if searched else []
+    vector_queries: Dict[int, VectorQuery] = {}
+    for i, embedding in zip(searched, query_embeddings):
+        query = queries[i]
+        if completed[i]:
+            # Merged with the labels completed from the prefix index
+            vector_queries[i] = VectorQuery(embedding, limit=query.offset + query.limit, filters=filters_list[i])
+        else:
+            vector_queries[i] = VectorQuery(embedding, limit=query.limit, offset=query.offset, filters=filters_list[i])
+    # Queries can choose the search mode, run each mode in one batch
+    hits: List[List[Hit]] = [[] for _ in queries]
+    for two_stage in [False, True]:
+        indices = [i for i in searched if queries[i].two_stage == two_stage and not queries[i].rerank]
+        if not indices:
+            continue
+        search = backend.search_two_stage if two_stage else backend.search
+        for i, query_hits in zip(indices, await search([vector_queries[i] for i in indices])):
+            hits[i] = query_hits
+    rerank_indices = [i for i in searched if queries[i].rerank]
+    if rerank_indices:
+        rerank_embeddings = await embed_rerank_strings([queries[i].string for i in rerank_indices])
+        for two_stage in [False, True]:
+            indices = [j for j, i in enumerate(rerank_indices) if queries[i].two_stage == two_stage]
+            if not indices:
+                continue
+            cascade_hits = await backend.search_cascade(
+                [vector_queries[rerank_indices[j]] for j in indices],
+                [rerank_embeddings[j] for j in indices],
+                [queries[rerank_indices[j]].rerank_candidates for j in indices],
+                two_stage,
+            )
+            for j, query_hits in zip(indices, cascade_hits):
+                hits[rerank_indices[j]] = query_hits
+    for i, query in enumerate(queries):
+        if completed[i]:
+            vector_hits = hits[i] if i in vector_queries else None
+            hits[i] = autocomplete_hits(query.string, query.offset, query.limit, filters_list[i], vector_hits)
+    hydrated = await hydrate_hits(hits, fields_lists)
+    for query_results in hydrated:
+        RESULTS_PER_QUERY.observe(len(query_results), endpoint="/bulk-lookup")
+    return json_response({query.string: query_results for query, query_results in zip(queries, hydrated)})
+
+
+@app.post(
+    "/annotate",
+    summary="Annotate a text with the concepts it mentions.",
+    description="""Looks up all the token n-grams of the text in one batch, and returns the best scored
+    non-overlapping annotations with their character offsets.""",
+    response_model=List[Annotation],
+    tags=["annotate"],
+)
+async def annotate(
+    request: Annotated[AnnotateRequest, Body(description="The text to annotate and the annotation options.")],
+) -> Response:
+    """
+    Returns the concepts found in the text.
+    """
+    spans = candidate_spans(request.text, request.max_ngram)
+    QUERIES_PER_REQUEST.observe(len(spans), endpoint="/annotate")
+    if not spans:
+        return json_response([])
+    # The same span can appear multiple times in a text, only look it up once
+    span_strings = list({normalize_string(span.text): None for span in spans})
+    span_embeddings = await embed_strings(span_strings)
+    filters = build_filters(request.biolink_type, request.only_prefixes, request.exclude_prefixes)
+    hits = await backend.search([VectorQuery(embedding, limit=1, filters=filters) for embedding in span_embeddings])
+    results = await hydrate_hits(hits, [["label", "types"]] * len(hits))
+    best_results = {string: span_results[0] for string, span_results in zip(span_strings, results) if span_results}
+    annotations = []
+    for span in spans:
+        result = best_results.get(normalize_string(span.text))
+        if result is not None and result["score"] >= request.min_score:
+            annotations.append(
+                {
+                    "start": span.start,
+                    "end": span.end,
+                    "text": span.text,
+                    "curie": result["curie"],
+                    "label": result["label"],
+                    "types": result["types"],
+                    "score": result["score"],
+                }
+            )
+    annotations = select_non_overlapping(annotations)
+    RESULTS_PER_QUERY.observe(len(annotations), endpoint="/annotate")
+    return json_response(annotations)
+
+
+class JobStatus(BaseModel):
+    id: str
+    status: str = Field(description="`queued`, `running`, `done`, `failed` or `cancelled`.")
+    format: str
+    header: bool
+    params: dict = Field(description="The lookup parameters used to resolve the labels.")
+    lines_total: int
+    lines_done: int
+    labels_resolved: int = Field(description="Number of distinct labels searched in the vector store.")
+    labels_reused: int = Field(description="Number of lines with a label already resolved earlier in the file.")
+    error: Union[str, None]
+    created_at: float
+    started_at: Union[float, None]
+    finished_at: Union[float, None]
+
+
+async def resolve_job_labels(strings: List[str], params: dict) -> List[List[dict]]:
+    """Resolve a batch of distinct labels of a job, in one batch of embeddings and one search like /bulk-lookup."""
+    # Bypass the cache of query embeddings, the labels of a file would evict the strings looked up by users
+    with timed("embed"):
+        embeddings = await embedding_batcher.embed(strings)
+    filters = build_filters(params["biolink_type"], params["only_prefixes"], params["exclude_prefixes"])
+    queries = [VectorQuery(embedding, limit=params["limit"], filters=filters) for embedding in embeddings]
+    hits = await (backend.search_two_stage(queries) if params["two_stage"] else backend.search(queries))
+    return await hydrate_hits(hits, [params["fields"]] * len(hits))
+
+
+# Bulk resolution jobs, run in the background by the workers of the API, one job at a time by default
+jobs = JobStore(
+    os.getenv("JOBS_PATH", "data/jobs"),
+    resolve_job_labels,
+    batch_size=int(os.getenv("JOB_BATCH_SIZE", "256")),
+    concurrency=int(os.getenv("JOB_WORKERS", "1")),
+)
+
+
+@app.post(
+    "/jobs",
+    summary="Start a job resolving all the labels of a file.",
+    description="""The body of the request is the file, with one label per line: TSV files with the label in the first
+    column, or JSONL files with a `string` in each object. The file is resolved in the background, use the `id` of the
+    job to get its progress from `/jobs/{id}`, and stream its results from `/jobs/{id}/results`.""",
+    response_model=JobStatus,
+    status_code=202,
+    tags=["jobs"],
+)
+async def create_job(
+    request: Request,
+    file_format: Annotated[Literal["tsv", "jsonl"], Query(alias="format", description="Format of the file.")] = "tsv",
+    header: Annotated[bool, Query(description="Skip the first line of the file.")] = False,
+    limit: Annotated[int, Query(description="The number of results to return for each label.", ge=0, le=1000)] = 10,
+    biolink_type: Annotated[
+        Union[str, None], Query(description="The Biolink type to filter to, e.g. `biolink:Disease`.")
+    ] = None,
+    only_prefixes: Annotated[
+        Union[str, None], Query(description="Pipe-separated list of prefixes to filter to, e.g. `MONDO|EFO`.")
+    ] = None,
+    exclude_prefixes: Annotated[
+        Union[str, None], Query(description="Pipe-separated list of prefixes to exclude, e.g. `UMLS|EFO`.")
+    ] = None,
+    fields: Annotated[
+        Union[str, None],
+        Query(description="Pipe-separated list of the fields of the results to return, e.g. `label|types`."),
+    ] = None,
+    include_synonyms: Annotated[bool, Query(description="Return the synonyms of the results.")] = True,
+    two_stage: Annotated[
+        bool,
+        Query(description="Search the concepts centroids first, then rescore the synonyms of the best concepts only."),
+    ] = two_stage_default,
+) -> Response:
+    """
+    Returns the status of the job created.
+    """
+    params = {
+        "limit": limit,
+        "biolink_type": biolink_type,
+        "only_prefixes": only_prefixes,
+        "exclude_prefixes": exclude_prefixes,
+        # Check the fields before receiving the file
+        "fields": result_fields(fields, include_synonyms),
+        "two_stage": two_stage,
+    }
+    status = await jobs.create(request.stream(), file_format, params, header)
+    return json_response(status, status_code=202)
+
+
+@app.get("/jobs/{job_id}", summary="Get the progress of a job.", response_model=JobStatus, tags=["jobs"])
+async def get_job(job_id: str) -> Response:
+    status = await asyncio.to_thread(jobs.get, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return json_response(status)
+
+
+@app.get(
+    "/jobs/{job_id}/results",
+    summary="Stream the results of a job.",
+    description="""Returns one JSON object per line of the file, with its `line` number, `string` and `results`,
+    in the order of the file. The results are streamed as they are resolved until the job is finished.""",
+    response_class=StreamingResponse,
+    tags=["jobs"],
+)
+async def get_job_results(job_id: str) -> StreamingResponse:
+    if await asyncio.to_thread(jobs.get, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return StreamingResponse(jobs.stream_results(job_id), media_type="application/x-ndjson")
+
+
+@app.delete("/jobs/{job_id}", summary="Cancel a job and delete its results.", status_code=204, tags=["jobs"])
+async def delete_job(job_id: str) -> Response:
+    if await asyncio.to_thread(jobs.get, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    await asyncio.to_thread(jobs.cancel, job_id)
+    return Response(status_code=204)
+
+
+async def embed_strings(strings: List[str]) -> list:
+    """Embed a list of strings in one batch, skipping the ones already in cache."""
+    with timed("embed"):
+        return await embedding_cache.aembed(strings, embedding_batcher.embed)
+
+
+async def embed_rerank_strings(strings: List[str]) -> list:
+    """Embed the strings with the rerank model, only needed for the queries reranked so they are not cached."""
+    with timed("rerank_embed"):
+        return await asyncio.get_running_loop().run_in_executor(embedding_executor, embed_rerank, strings)
+
+
+def check_rerank(rerank: bool) -> bool:
+    if rerank and RERANK_EMBEDDING_MODEL is None:
+        raise HTTPException(
+            status_code=400, detail="Reranking is not available, the service has no RERANK_EMBEDDING_MODEL"
+        )
+    return rerank
+
+
+def build_filters(
+    biolink_type: Union[str, None] = None,
+    only_prefixes: Union[str, None] = None,
+    exclude_prefixes: Union[str, None] = None,
+) -> Union[SearchFilters, None]:
+    """Translate the lookup parameters to filters applied by the vector store during the search."""
+    if not biolink_type and not only_prefixes and not exclude_prefixes:
+        return None
+    return SearchFilters(
+        types=[biolink_type.removeprefix("biolink:")] if biolink_type else [],
+        prefixes=split_prefixes(only_prefixes) if only_prefixes else [],
+        exclude_prefixes=split_prefixes(exclude_prefixes) if exclude_prefixes else [],
+    )
+
+
+def split_prefixes(prefixes: str) -> List[str]:
+    return [prefix.strip() for prefix in prefixes.split("|") if prefix.strip()]
+
+
+def result_fields(fields: Union[str, None] = None, include_synonyms: bool = True) -> List[str]:
+    """Fields of the clique documents to return, the `curie` and `score` of the results are always returned."""
+    selected = split_prefixes(fields) if fields else CLIQUE_FIELDS
+    unknown = [field for field in selected if field not in CLIQUE_FIELDS + ["curie", "score"]]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}, use {CLIQUE_FIELDS}")
+    return [field for field in CLIQUE_FIELDS if field in selected and (include_synonyms or field != "synonyms")]
+
+
+async def hydrate_hits(hits_lists: List[List[Hit]], fields_lists: List[List[str]]) -> List[List[dict]]:
+    """Retrieve the fields of the clique documents of all the hits in one request, and build the lookup results.
+
+    `fields_lists` are the fields of the clique documents returned for each list of hits.
+    """
+    fields = [field for field in CLIQUE_FIELDS if any(field in list_fields for list_fields in fields_lists)]
+    curies = list({hit.curie for hits in hits_lists for hit in hits})
+    if not curies:
+        return [[] for _ in hits_lists]
+    with timed("hydrate"):
+        # Results with only the curie and score do not need the clique documents
+        cliques = await backend.get_cliques(curies, fields) if fields else {}
+        return [
+            [hit_to_result(hit, cliques.get(hit.curie), list_fields) for hit in hits]
+            for hits, list_fields in zip(hits_lists, fields_lists)
+        ]
+
+
+def json_response(results, status_code: int = 200) -> Response:
+    """Serialize the results built by the API with orjson, without validating them again with the response model."""
+    with timed("serialize"):
+        return Response(
+            orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY),
+            status_code=status_code,
+            media_type="application/json",
+        )
+
+
+def hit_to_result(hit: Hit, clique: Union[dict, None], fields: List[str] = CLIQUE_FIELDS) -> dict:
+    if clique is None:
+        # The clique document is missing (e.g. still loading), fallback to what is in the synonym point
+        clique = {"label": hit.label, "synonyms": [], "types": hit.payload.get("types", [])}
+    result = {"curie": hit.curie}
+    for field in fields:
+        result[field] = clique.get(field)
+    result["score"] = hit.score
+    return result
+
+
+async def warmup() -> None:
+    """Load the model and embed batches of representative sizes, then run a search to open the backend clients."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    await loop.run_in_executor(embedding_executor, get_embedding_model)
+    if RERANK_EMBEDDING_MODEL:
+        await loop.run_in_executor(embedding_executor, get_embedding_model, RERANK_EMBEDDING_MODEL)
+    startup["model_load_s"] = time.perf_counter() - start
+    startup["warmup_s"] = await loop.run_in_executor(
+        embedding_executor, warmup_model, [1, embedding_batcher.max_batch_size]
+    )
+    try:
+        await loop.run_in_executor(None, backend.check_vector_size, EMBEDDING_SIZE, RERANK_EMBEDDING_SIZE)
+    except ValueError as e:
+        # The store was loaded with another model, lookups would fail: stay not ready
+        print(f"Error: {e}")
+        startup["backend_error"] = str(e)
+        return
+    except Exception:
+        # Not reachable yet, reported by the search below
+        pass
+    try:
+        await backend.search([VectorQuery((await embed_strings(["headache"]))[0], limit=1)])
+    except Exception as e:
+        # The vector store can start after the API, lookups will connect to it when it is up
+        print(f"Error searching the vector store during warmup: {e}")
+        startup["backend_error"] = str(e)
+    startup["import_to_ready_s"] = time.perf_counter() - import_time
+    startup["ready"] = True
+    print(
+        f"Ready {startup['import_to_ready_s']:.2f}s after import, model loaded in {startup['model_load_s']:.2f}s "
+        f"and warmed up in {startup['warmup_s']:.2f}s"
     )
 
-    # Deduplicate match on the same ID
-    seen_ids = set()
-    new_list = []
-    for hit in hits:
-        curie = hit.payload["curie"]
-        if curie not in seen_ids:
-            seen_ids.add(curie)
-            if "embedded_label" in hit.payload:
-                del hit.payload["embedded_label"]
-            hit.payload["score"] = hit.score
-            new_list.append(hit.payload)
-    # print(new_list)
-    return new_list
 
+@app.get("/health", summary="Check that the service is running.", tags=["health"])
+async def health() -> dict:
+    return {"status": "ok"}
+
+
+@app.get("/ready", summary="Check that the model is loaded and warmed up.", tags=["health"])
+async def ready() -> JSONResponse:
+    """
+    Returns 200 once the service is ready to answer lookups quickly, 503 before.
+    """
+    return JSONResponse(startup, status_code=200 if startup["ready"] else 503)
+
+
+@app.get("/metrics", summary="Get the metrics of the service in the Prometheus format.", tags=["health"])
+async def metrics() -> PlainTextResponse:
+    """
+    Returns the requests count and latency, the time spent in each stage, the batch sizes and the cache hits.
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/", include_in_schema=False)
@@ -1,132 +1,544 @@
-import os
+import argparse
+import hashlib
 import json
-import pandas as pd
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import (
-    Distance,
-    FieldCondition,
-    Filter,
-    MatchText,
-    PointStruct,
-    UpdateResult,
-    VectorParams,
-    PointStruct,
-    SearchParams,
-)
-from tqdm import tqdm
-
-from fastembed.embedding import FlagEmbedding as Embedding
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-start_time = time.time()
+import numpy as np
+from tqdm import tqdm
 
-# Initialize embedding model and vectordb client
-flag_embeddings = Embedding(model_name="BAAI/bge-small-en-v1.5", max_length=512)
-flag_embeddings_size = 384
+from src.backends import VectorBackend, add_backend_arguments, backend_from_args, point_id
+from src.centroids import CentroidAccumulator
+from src.embedding_cache import EmbeddingCache, normalize_string
+from src.embeddings import (
+    EMBEDDING_SIZE,
+    EMBEDDING_THREADS,
+    RERANK_EMBEDDING_MODEL,
+    RERANK_EMBEDDING_SIZE,
+    GenEmbeddings,
+)
+from src.metrics import INGEST_LABELS, StageTimer, write_metrics
+from src.prefix_index import PrefixIndex
 
 # NOTE: fastembed supports flag (5th MTEB) and jinaai: https://qdrant.github.io/fastembed/examples/Supported_Models/
 # BioBERT: https://pypi.org/project/biobert-embedding/
 # Angle embedding (2nd MTEB): https://huggingface.co/WhereIsAI/UAE-Large-V1
 
+flag_embeddings_size = EMBEDDING_SIZE
 
-vectordb = QdrantClient(
-    host="qdrant",
-    prefer_grpc=True,
-)
+# One row per label to embed: (curie, label_to_embed, types, preferred_name, names)
+Row = Tuple[str, str, List[str], str, List[str]]
 
 
-# TODO: load multiple vectors per point?
-# We can upload vectors in a point by name: https://qdrant.tech/documentation/concepts/points/
-# But the different vectors name need to be set at collection creation
-# https://blog.qdrant.tech/storing-multiple-vectors-per-object-in-qdrant-c1da8b1ad727
-vectordb.recreate_collection(
-    collection_name="concept-resolver",
-    vectors_config=VectorParams(size=flag_embeddings_size, distance=Distance.COSINE),
-)
+class FileBatch(NamedTuple):
+    """A batch of rows from one synonyms file, `end_line` is the number of lines of the file fully read."""
+
+    filename: str
+    file_hash: str
+    rows: List[Row]
+    end_line: int
+    last: bool
+
+
+def hash_file(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class DedupStats:
+    """Count the labels read by outcome: collapsed with an equivalent label of their clique,
+    embedding reused from an identical normalized label, or embedded."""
+
+    def __init__(self):
+        self.counts = {"collapsed": 0, "reused": 0, "embedded": 0}
+
+    def add(self, outcome: str, labels: int) -> None:
+        self.counts[outcome] += labels
+        INGEST_LABELS.inc(labels, outcome=outcome)
+
+    def report(self) -> str:
+        labels = sum(self.counts.values())
+        saved = 1 - self.counts["embedded"] / labels if labels else 0
+        return (
+            f"Dedup: {labels} labels, {self.counts['collapsed']} collapsed with an equivalent label of their clique, "
+            f"{self.counts['reused']} reusing the embedding of an identical label, {self.counts['embedded']} "
+            f"embedded ({saved:.1%} of the embeddings saved)"
+        )
+
+
+def read_synonyms(
+    file_path: str, start_line: int = 0, stats: Optional[DedupStats] = None
+) -> Iterator[Tuple[int, Row]]:
+    """Reader stage: yield the line number and one row per label to embed from a Babel synonyms file.
+
+    Labels of a clique that only differ by case or whitespace are collapsed in one row, the models are uncased
+    so they would get the same embedding.
+    """
+    # {"curie": "UMLS:C4085944", "names": ["ATIR101", "allodepleted T cell immunotherapeutic ATIR101", "Allodepleted T Cell Immunotherapeutic ATIR101"], "types": ["Cell", "AnatomicalEntity", "PhysicalEssence", "OrganismalEntity", "SubjectOfInvestigation", "BiologicalEntity", "ThingWithTaxon", "NamedThing", "Entity", "PhysicalEssenceOrOccurrent"], "preferred_name": "Allodepleted T Cell Immunotherapeutic ATIR101", "shortest_name_length": 7}
+    with open(file_path, "r") as file:
+        for line_number, line in enumerate(file):
+            if line_number < start_line:
+                continue
+            json_obj = json.loads(line)
+            if "preferred_name" not in json_obj or "names" not in json_obj:
+                continue
+            curie = json_obj["curie"]
+            preferred_name = json_obj["preferred_name"]
+            # Keep the preferred name when it is one of the equivalent labels
+            labels: Dict[str, str] = {}
+            for label in [preferred_name, *json_obj["names"]]:
+                labels.setdefault(normalize_string(label), label)
+            if stats is not None:
+                read_count = len(json_obj["names"]) + (preferred_name not in json_obj["names"])
+                stats.add("collapsed", read_count - len(labels))
+
+            for label_to_embed in labels.values():
+                yield line_number, (curie, label_to_embed, json_obj["types"], preferred_name, json_obj["names"])
+
+
+def read_batches(
+    filename: str,
+    file_path: str,
+    file_hash: str,
+    batch_size: int,
+    start_line: int = 0,
+    stats: Optional[DedupStats] = None,
+) -> Iterator[FileBatch]:
+    """Split the rows of a file in batches, the last batch of the file is always yielded, even if empty."""
+    batch: List[Row] = []
+    last_line = start_line
+    for line_number, row in read_synonyms(file_path, start_line, stats):
+        if len(batch) >= batch_size and line_number != last_line:
+            # Only cut batches between lines, so the progress offset never points in the middle of a clique
+            yield FileBatch(filename, file_hash, batch, line_number, False)
+            batch = []
+        batch.append(row)
+        last_line = line_number
+    yield FileBatch(filename, file_hash, batch, -1, True)
+
+
+class Manifest:
+    """Checkpoint of the loading progress: the hash of each file, the number of lines loaded and if it is complete.
+
+    `version` is the Qdrant version the files were loaded in, None when the collections are written in place.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.version: Optional[str] = None
+        self.files: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                content = json.load(f)
+            self.version = content.get("version")
+            self.files = content["files"]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "files": self.files}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+# Embedding models of each worker process, loaded once by init_embedding_worker()
+worker_embeddings: Optional[GenEmbeddings] = None
+worker_rerank_embeddings: Optional[GenEmbeddings] = None
+
+
+def init_embedding_worker(threads: Optional[int] = None) -> None:
+    global worker_embeddings, worker_rerank_embeddings
+    worker_embeddings = GenEmbeddings(threads=threads)
+    worker_embeddings.model  # Load the model when the worker starts, instead of while embedding its first batch
+    if RERANK_EMBEDDING_MODEL:
+        worker_rerank_embeddings = GenEmbeddings(RERANK_EMBEDDING_MODEL, threads=threads)
+        worker_rerank_embeddings.model
+
 
-# Directory containing the .txt files
-synonym_dir = "data/synonyms"
-chunk_size = 100000
+def embed_labels(labels: List[str]) -> Tuple[np.ndarray, Optional[np.ndarray], float]:
+    """Embedding stage, runs in a worker process.
 
-points_count = 0
-for filename in os.listdir(synonym_dir):
-    if filename.endswith(".txt"):
-        # print(f"Loading {filename}")
-        file_path = os.path.join(synonym_dir, filename)
-        category = filename.replace(".txt", "")
+    Returns the embeddings, the embeddings of the rerank model if there is one, and the time spent.
+    """
+    start = time.time()
+    embeddings = worker_embeddings.embed(labels)
+    rerank_embeddings = worker_rerank_embeddings.embed(labels) if worker_rerank_embeddings is not None else None
+    return embeddings, rerank_embeddings, time.time() - start
 
-        # {"curie": "UMLS:C4085944", "names": ["ATIR101", "allodepleted T cell immunotherapeutic ATIR101", "Allodepleted T Cell Immunotherapeutic ATIR101"], "types": ["Cell", "AnatomicalEntity", "PhysicalEssence", "OrganismalEntity", "SubjectOfInvestigation", "BiologicalEntity", "ThingWithTaxon", "NamedThing", "Entity", "PhysicalEssenceOrOccurrent"], "preferred_name": "Allodepleted T Cell Immunotherapeutic ATIR101", "shortest_name_length": 7}
 
-        chunk_data = []
-        with open(file_path, "r") as file:
-            for line in tqdm(file, desc=f"Loading {filename}"):
-                json_obj = json.loads(line)
-                if "preferred_name" not in json_obj or "names" not in json_obj:
+def build_payload(row: Row, source: str, source_hash: str) -> dict:
+    """Payload of a synonym point, only what is needed to filter the search, the rest is in the clique document."""
+    curie, label_to_embed, types, preferred_name, names = row
+    return {
+        "curie": curie,
+        "prefix": curie.split(":")[0],
+        "types": types,
+        "embedded_label": label_to_embed,
+        "source": source,
+        "source_hash": source_hash,
+    }
+
+
+def build_clique_payload(row: Row, source: str, source_hash: str) -> dict:
+    curie, label_to_embed, types, preferred_name, names = row
+    return {
+        "curie": curie,
+        "label": preferred_name,
+        "synonyms": names,
+        "types": types,
+        "source": source,
+        "source_hash": source_hash,
+    }
+
+
+def build_centroid_payload(row: Row, source: str, source_hash: str) -> dict:
+    curie, label_to_embed, types, preferred_name, names = row
+    return {
+        "curie": curie,
+        "prefix": curie.split(":")[0],
+        "types": types,
+        "source": source,
+        "source_hash": source_hash,
+    }
+
+
+class RateLimiter:
+    """Spread the uploads so no more than `rate` labels per second are sent, shared by the upload threads.
+
+    Loading while the API is serving competes with the searches for the CPU of the vector store,
+    uploading at a steady rate keeps the latency of the lookups stable.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, labels: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + labels / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def upload_batch(
+    backend: VectorBackend,
+    batch: FileBatch,
+    embeddings: np.ndarray,
+    rerank_embeddings: Optional[np.ndarray] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> float:
+    """Upload stage, runs in a thread. Returns the time spent, without the time waiting for the rate limiter."""
+    if rate_limiter is not None:
+        rate_limiter.wait(len(batch.rows))
+    start = time.time()
+    if batch.rows:
+        backend.upsert(
+            [point_id(row[0], row[1]) for row in batch.rows],
+            embeddings,
+            [build_payload(row, batch.filename, batch.file_hash) for row in batch.rows],
+            rerank_embeddings,
+        )
+        # Batches are only cut between lines, so all the rows of a clique are in the same batch
+        clique_rows = list({row[0]: row for row in batch.rows}.values())
+        backend.upsert_cliques([build_clique_payload(row, batch.filename, batch.file_hash) for row in clique_rows])
+        # And the centroid of a clique is the mean of all its synonyms
+        centroids = CentroidAccumulator()
+        centroids.add(
+            [row[0] for row in batch.rows],
+            embeddings,
+            [build_centroid_payload(row, batch.filename, batch.file_hash) for row in batch.rows],
+        )
+        backend.upsert_centroids(*centroids.flush())
+    return time.time() - start
+
+
+def load_synonyms(
+    backend: VectorBackend,
+    synonym_dir: str = "data/synonyms",
+    manifest: Optional[Manifest] = None,
+    workers: int = os.cpu_count() or 1,
+    batch_size: int = 10000,
+    upload_parallel: int = 4,
+    max_rate: Optional[float] = None,
+    embedding_cache_size: int = 100000,
+) -> int:
+    """Load the Babel synonyms in the vector store, with the reading, embedding and uploading of batches overlapping.
+
+    Batches are embedded by a pool of worker processes and uploaded by a pool of threads, the number of batches
+    waiting between each stage is bounded so memory use stays constant.
+
+    Files already loaded with the same hash in the manifest are skipped, partially loaded files are resumed,
+    and the points of files that changed or disappeared since the last load are deleted.
+
+    `max_rate` limits the number of labels uploaded per second, to load while the API is serving.
+
+    Labels are only embedded once per normalized string: the embeddings of the last `embedding_cache_size`
+    distinct labels are kept, and reused for the identical labels of other cliques and files.
+    """
+    if manifest is None:
+        manifest = Manifest(os.path.join(synonym_dir, "manifest.json"))
+    read_timer = StageTimer("Read")
+    embed_timer = StageTimer("Embed")
+    upload_timer = StageTimer("Upload")
+    # Split the cores between the workers, instead of each ONNX session trying to use all of them
+    threads_per_worker = EMBEDDING_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    max_embedding_batches = workers * 2
+    max_upload_batches = upload_parallel * 2
+    rate_limiter = RateLimiter(max_rate) if max_rate else None
+    dedup_stats = DedupStats()
+    # Vectors of the fast model, followed by the ones of the rerank model if there is one
+    embedding_cache = EmbeddingCache(max_size=embedding_cache_size)
+    vector_size = EMBEDDING_SIZE + (RERANK_EMBEDDING_SIZE or 0)
+
+    filenames = sorted(filename for filename in os.listdir(synonym_dir) if filename.endswith(".txt"))
+    for filename in list(manifest.files):
+        if filename not in filenames:
+            print(f"Deleting the points of {filename}, removed since last load")
+            backend.delete_source(filename)
+            del manifest.files[filename]
+            manifest.save()
+
+    def iter_batches() -> Iterator[FileBatch]:
+        for filename in filenames:
+            file_path = os.path.join(synonym_dir, filename)
+            file_hash = hash_file(file_path)
+            entry = manifest.files.get(filename)
+            if entry and entry["sha256"] == file_hash:
+                if entry["complete"]:
+                    print(f"Skipping {filename}, unchanged since last load")
                     continue
-                curie = json_obj["curie"]
-                labels = json_obj["names"]
-                # print(line)
-                preferred_name = json_obj["preferred_name"]
-
-                if preferred_name not in labels:
-                    labels.append(preferred_name)
-
-                for label_to_embed in labels:
-                    chunk_data.append(
-                        (
-                            curie,
-                            label_to_embed,
-                            json_obj["types"],
-                            json_obj["preferred_name"],
-                            json_obj["names"],
-                        )
-                    )
-
-                if len(chunk_data) >= chunk_size:
-                    # Process the chunk
-                    labels = [item[1] for item in chunk_data]
-                    embeddings = list(flag_embeddings.embed(labels))
-
-                    points = [
-                        PointStruct(
-                            id=points_count + i,
-                            vector=embedding,
-                            payload={
-                                "curie": chunk_data[i][0],
-                                "label": chunk_data[i][3],
-                                "synonyms": chunk_data[i][4],
-                                "types": chunk_data[i][2],
-                                "embedded_label": chunk_data[i][1],
-                            },
-                        )
-                        for i, embedding in enumerate(embeddings)
-                    ]
-                    vectordb.upsert(collection_name="concept-resolver", points=points)
-                    points_count += len(chunk_data)
-                    chunk_data = []  # Reset the chunk data
-
-        # Process any remaining data in the chunk
-        # TODO: make this a function to avoid repetition
-        if chunk_data:
-            labels = [item[1] for item in chunk_data]
-            embeddings = list(flag_embeddings.embed(labels))
-            points = [
-                PointStruct(
-                    id=points_count + i,
-                    vector=embedding,
-                    payload={
-                        "curie": chunk_data[i][0],
-                        "label": chunk_data[i][3],
-                        "synonyms": chunk_data[i][4],
-                        "types": chunk_data[i][2],
-                        "embedded_label": chunk_data[i][1],
-                    },
-                )
-                for i, embedding in enumerate(embeddings)
-            ]
-            vectordb.upsert(collection_name="concept-resolver", points=points)
-            points_count += len(chunk_data)
-
-
-time_taken = (end_time - start_time) / 60
-print(f"Data processing and insertion completed in {time_taken}min")
+                start_line = entry["lines"]
+                print(f"Resuming {filename} from line {start_line}")
+            else:
+                start_line = 0
+                # Remember if points from another version of the file need to be deleted once it is loaded
+                manifest.files[filename] = {
+                    "sha256": file_hash,
+                    "lines": 0,
+                    "complete": False,
+                    "stale_points": entry is not None,
+                }
+                manifest.save()
+            yield from read_batches(filename, file_path, file_hash, batch_size, start_line, dedup_stats)
+
+    labels_count = 0
+    # Batches with the vectors found in cache, the positions of the labels embedded and their embeddings
+    embed_futures: Deque[Tuple[FileBatch, List[Optional[np.ndarray]], Dict[str, List[int]], Future]] = deque()
+    upload_futures: Deque[Tuple[FileBatch, Future]] = deque()
+    progress = tqdm(desc="Loading synonyms", unit="labels")
+
+    def wait_upload() -> None:
+        # Uploads are awaited in order, so all the batches before this one are already in the vector store
+        batch, upload_future = upload_futures.popleft()
+        upload_timer.add(len(batch.rows), upload_future.result())
+        progress.update(len(batch.rows))
+        entry = manifest.files[batch.filename]
+        if batch.last:
+            if entry.get("stale_points"):
+                # Remove the labels and cliques that are not in the new version of the file
+                backend.delete_source(batch.filename, keep_hash=batch.file_hash)
+                entry["stale_points"] = False
+            entry["complete"] = True
+        else:
+            entry["lines"] = batch.end_line
+        manifest.save()
+
+    def hand_off_embedding() -> None:
+        nonlocal labels_count
+        batch, vectors, missing, embed_future = embed_futures.popleft()
+        embeddings, rerank_embeddings, seconds = embed_future.result()
+        embed_timer.add(len(missing), seconds)
+        if rerank_embeddings is not None:
+            embeddings = np.hstack([embeddings, rerank_embeddings])
+        embedding_cache.fill(vectors, missing, list(embeddings))
+        embeddings = np.array(vectors, dtype=np.float32).reshape(len(vectors), vector_size)
+        if RERANK_EMBEDDING_SIZE:
+            embeddings, rerank_embeddings = embeddings[:, :EMBEDDING_SIZE], embeddings[:, EMBEDDING_SIZE:]
+        while len(upload_futures) >= max_upload_batches:
+            wait_upload()
+        upload_futures.append((batch, upload_pool.submit(upload_batch, backend, batch, embeddings, rerank_embeddings, rate_limiter)))
+        labels_count += len(batch.rows)
+
+    # Quantize the int8 models once, instead of in every worker process at the same time
+    GenEmbeddings().prepare()
+    if RERANK_EMBEDDING_MODEL:
+        GenEmbeddings(RERANK_EMBEDDING_MODEL).prepare()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_embedding_worker, initargs=(threads_per_worker,)
+    ) as embed_pool, ThreadPoolExecutor(max_workers=upload_parallel) as upload_pool:
+        batches = iter_batches()
+        while True:
+            start = time.time()
+            batch = next(batches, None)
+            if batch is None:
+                break
+            read_timer.add(len(batch.rows), time.time() - start)
+            while len(embed_futures) >= max_embedding_batches:
+                hand_off_embedding()
+            # Only embed the labels not seen in the previous batches, once per normalized label
+            vectors, missing = embedding_cache.lookup([row[1] for row in batch.rows])
+            dedup_stats.add("reused", len(batch.rows) - len(missing))
+            dedup_stats.add("embedded", len(missing))
+            embed_futures.append((batch, vectors, missing, embed_pool.submit(embed_labels, list(missing))))
+
+        while embed_futures:
+            hand_off_embedding()
+        while upload_futures:
+            wait_upload()
+    progress.close()
+
+    print(read_timer.report())
+    print(embed_timer.report(workers))
+    print(upload_timer.report(upload_parallel))
+    print(dedup_stats.report())
+    return labels_count
+
+
+def prefix_index_entries(synonym_dir: str) -> Iterator[Tuple[str, str, List[str], bool]]:
+    """Labels of all the synonyms files, with their CURIE, types and if they are the preferred label."""
+    filenames = sorted(filename for filename in os.listdir(synonym_dir) if filename.endswith(".txt"))
+    for filename in tqdm(filenames, desc="Building the prefix index"):
+        for _, (curie, label, types, preferred_name, names) in read_synonyms(os.path.join(synonym_dir, filename)):
+            yield label, curie, types, label == preferred_name
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load the Babel synonyms files in the vector store")
+    parser.add_argument("--synonym-dir", default="data/synonyms", help="Directory containing the .txt files")
+    add_backend_arguments(parser)
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="Number of processes generating embeddings"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000, help="Number of labels embedded and uploaded at once")
+    parser.add_argument("--upload-parallel", type=int, default=4, help="Number of batches uploaded concurrently")
+    parser.add_argument(
+        "--manifest", default="data/babel_manifest.json", help="Checkpoint file recording the loading progress"
+    )
+    parser.add_argument(
+        "--quantization", choices=["scalar", "binary"], help="Quantize the vectors to reduce the memory used (Qdrant)"
+    )
+    parser.add_argument(
+        "--on-disk", action="store_true", help="Store the original vectors on disk instead of in memory"
+    )
+    parser.add_argument("--hnsw-m", type=int, help="Number of edges per node in the HNSW index graph")
+    parser.add_argument("--hnsw-ef-construct", type=int, help="Number of neighbours considered to build the index")
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="Drop the secondary indexes while loading and build them at the end (pgvector)",
+    )
+    parser.add_argument(
+        "--prefix-index",
+        default="data/prefix_index",
+        help="Directory of the labels prefix index used for autocomplete, empty to not build it",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write the labels and time of each stage in this file, in the Prometheus text format",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the existing collection, only load new or changed files and resume partially loaded ones",
+    )
+    parser.add_argument(
+        "--version",
+        help="Name of the version loaded (Qdrant), a timestamp by default. With --incremental, the version recorded "
+        "in the manifest is resumed",
+    )
+    parser.add_argument(
+        "--max-shrink",
+        type=float,
+        default=0.5,
+        help="Do not publish the new version if it lost more than this fraction of the synonyms of the served one",
+    )
+    parser.add_argument(
+        "--rollback", action="store_true", help="Serve the previous version again instead of loading (Qdrant)"
+    )
+    parser.add_argument("--max-rate", type=float, help="Maximum number of labels uploaded per second")
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=100000,
+        help="Number of embeddings of distinct labels kept to reuse them for identical labels, 0 to disable",
+    )
+    parser.add_argument(
+        "--indexing-threads", type=int, help="Threads used by Qdrant to build the HNSW index, all the cores by default"
+    )
+    args = parser.parse_args()
+    if args.incremental and args.backend == "numpy":
+        parser.error("The numpy index is append-only, it does not support --incremental: reload it from scratch")
+    if args.rollback and args.backend != "qdrant":
+        parser.error(f"{args.backend} reloads its data in place, only Qdrant keeps a previous version to serve")
+
+    start_time = time.time()
+    backend = backend_from_args(args)
+    if args.rollback:
+        print(f"Serving version {backend.rollback()}")
+        return
+    manifest = Manifest(args.manifest)
+    if args.incremental:
+        # The manifest lists the files loaded in its version, resume that one and not the served one
+        args.version = args.version or manifest.version
+        if manifest.files and args.version != manifest.version:
+            parser.error(
+                f"{args.manifest} records the progress of version {manifest.version}, not {args.version}: "
+                "resume that version or run a full load"
+            )
+        if args.version and args.version not in backend.versions():
+            parser.error(f"Version {args.version} of {args.manifest} does not exist anymore, run a full load")
+    elif args.version in backend.versions():
+        # Recreating its collections would drop the served version or the one kept for rollback
+        parser.error(f"Version {args.version} already exists, load a new version or resume it with --incremental")
+    # Qdrant loads a new version next to the served one, other backends recreate their tables in place
+    backend.create(
+        flag_embeddings_size,
+        recreate=not args.incremental,
+        quantization=args.quantization,
+        on_disk=args.on_disk,
+        hnsw_m=args.hnsw_m,
+        hnsw_ef_construct=args.hnsw_ef_construct,
+        defer_indexes=args.defer_indexes,
+        version=args.version,
+        indexing_threads=args.indexing_threads,
+        rerank_vector_size=RERANK_EMBEDDING_SIZE,
+    )
+    if not args.incremental:
+        manifest.files = {}
+    manifest.version = getattr(backend, "version", None)
+    manifest.save()
+    labels_count = load_synonyms(
+        backend,
+        synonym_dir=args.synonym_dir,
+        manifest=manifest,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        upload_parallel=args.upload_parallel,
+        max_rate=args.max_rate,
+        embedding_cache_size=args.embedding_cache_size,
+    )
+    backend.build_indexes(hnsw_m=args.hnsw_m, hnsw_ef_construct=args.hnsw_ef_construct)
+    backend.publish(max_shrink=args.max_shrink)
+    if args.prefix_index:
+        # The index is rebuilt from all the files, reading them is fast compared to embedding
+        prefix_labels = PrefixIndex.build(prefix_index_entries(args.synonym_dir), args.prefix_index)
+        print(f"Prefix index of {prefix_labels} labels written to {args.prefix_index}")
+
+    time_taken = (time.time() - start_time) / 60
+    print(f"Data processing and insertion of {labels_count} labels completed in {time_taken}min")
+    if args.metrics_file:
+        write_metrics(args.metrics_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1304 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import numpy as np
+import psycopg
+from pgvector.psycopg import register_vector, register_vector_async
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.models import (
+    Batch,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CollectionStatus,
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+    Distance,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    HnswConfigDiff,
+    MatchAny,
+    MatchValue,
+    NamedVector,
+    PayloadSchemaType,
+    QuantizationConfig,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    SearchRequest,
+    VectorParams,
+)
+
+from src.metrics import timed
+
+# Name of the synonyms collection (or table), of the collection storing the clique documents,
+# and of the collection with one centroid vector per CURIE
+COLLECTION_NAME = "concept-resolver"
+CLIQUES_COLLECTION_NAME = "concept-resolver-cliques"
+CENTROIDS_COLLECTION_NAME = "concept-resolver-centroids"
+# With Qdrant these names are aliases of the collections of the version of the data being served,
+# named `<alias>__<version>`, so a new version can be loaded while the previous one is searched
+QDRANT_ALIASES = [COLLECTION_NAME, CLIQUES_COLLECTION_NAME, CENTROIDS_COLLECTION_NAME]
+VERSION_SEPARATOR = "__"
+# Names of the vectors of the synonyms points when they also store the vectors of the rerank model (Qdrant)
+FAST_VECTOR = "fast"
+RERANK_VECTOR = "rerank"
+
+# Namespaces used to generate deterministic IDs for the synonyms points and the clique documents
+POINT_ID_NAMESPACE = uuid.UUID("0f5c1a2e-6d4b-4f8e-9a57-3c2d1b0e8f71")
+CLIQUE_ID_NAMESPACE = uuid.UUID("6b1e4f0c-2a9d-4c37-8e15-d0a3f7b29c64")
+
+PG_CONNECT = "dbname=postgres user=postgres password=password host=db"
+
+# Fields of the clique documents returned by lookups, and of the synonyms payloads needed to build the hits
+CLIQUE_FIELDS = ["label", "synonyms", "types"]
+HIT_PAYLOAD_FIELDS = ["curie", "embedded_label", "types", "source"]
+
+
+def point_id(*parts: str) -> str:
+    """Deterministic ID, so reloading the same label upserts the existing point instead of adding a new one."""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, "\t".join(parts)))
+
+
+def clique_id(curie: str) -> str:
+    return str(uuid.uuid5(CLIQUE_ID_NAMESPACE, curie))
+
+
+class SearchFilters(NamedTuple):
+    """Restrict the search to synonyms with one of these types, prefixes, sources or CURIEs (empty lists are ignored)."""
+
+    types: List[str] = []
+    prefixes: List[str] = []
+    exclude_prefixes: List[str] = []
+    sources: List[str] = []
+    curies: List[str] = []
+
+
+class VectorQuery(NamedTuple):
+    vector: np.ndarray
+    limit: int = 10
+    offset: int = 0
+    filters: Optional[SearchFilters] = None
+    # Search the vectors of the rerank model, `vector` is then an embedding of the rerank model
+    rerank: bool = False
+
+
+class Hit(NamedTuple):
+    """Best synonym found for a CURIE, with its cosine similarity to the query."""
+
+    curie: str
+    label: str
+    score: float
+    payload: dict
+
+
+def dedup_hits(hits: List[Hit]) -> List[Hit]:
+    """Deduplicate matches on the same ID, keeping the best scored synonym."""
+    seen_ids = set()
+    new_list = []
+    for hit in hits:
+        if hit.curie not in seen_ids:
+            seen_ids.add(hit.curie)
+            new_list.append(hit)
+    return new_list
+
+
+def project(document: dict, fields: Optional[List[str]]) -> dict:
+    """Keep the `curie` and the `fields` of a document, or the whole document when fields are not given."""
+    if fields is None:
+        return document
+    return {key: document[key] for key in ["curie", *fields] if key in document}
+
+
+def fuse_hits(hits_lists: List[List[Hit]], k: int = 60) -> List[Hit]:
+    """Order the CURIEs of ranked lists of hits by reciprocal rank fusion, the sum of 1 / (k + rank) in each list.
+
+    The fusion only orders the hits, a CURIE keeps the hit and score of the first list it is found in.
+    """
+    fused_ranks: Dict[str, float] = {}
+    best_hits: Dict[str, Hit] = {}
+    for hits in hits_lists:
+        for rank, hit in enumerate(dedup_hits(hits)):
+            fused_ranks[hit.curie] = fused_ranks.get(hit.curie, 0.0) + 1 / (k + rank + 1)
+            best_hits.setdefault(hit.curie, hit)
+    ranked = sorted(fused_ranks, key=lambda curie: fused_ranks[curie], reverse=True)
+    return [best_hits[curie] for curie in ranked]
+
+
+class VectorBackend(ABC):
+    """Store of the synonyms vectors and of the clique documents, used by the loaders and by lookup().
+
+    Ingestion methods are synchronous, search methods are async so they can be awaited by the API.
+    Payloads of synonyms points contain at least the `curie`, `embedded_label` and `source` of the point.
+    """
+
+    # Initial over-fetch factor used to get enough distinct CURIEs, and maximum hits fetched per query
+    overfetch = int(os.getenv("SEARCH_OVERFETCH", "3"))
+    max_fetch = 10000
+    # Number of candidate concepts retrieved from the centroids for each result of a two-stage search
+    centroid_candidates = int(os.getenv("SEARCH_CENTROID_CANDIDATES", "5"))
+
+    @abstractmethod
+    def create(self, vector_size: int, recreate: bool = True, **options) -> None:
+        """Create the collections, when `recreate` is False existing collections are kept."""
+
+    @abstractmethod
+    def vector_size(self) -> Optional[int]:
+        """Size of the vectors of the synonyms collection, None if it does not exist yet."""
+
+    def rerank_vector_size(self) -> Optional[int]:
+        """Size of the rerank vectors of the synonyms, None if they are not stored."""
+        return None
+
+    def check_vector_size(self, vector_size: int, rerank_vector_size: Optional[int] = None) -> None:
+        """Raise a ValueError if the collection exists with vectors of another size, e.g. loaded with another model."""
+        existing_size = self.vector_size()
+        if existing_size is None:
+            return
+        if existing_size != vector_size:
+            raise ValueError(
+                f"The vector store has vectors of size {existing_size}, but the embedding model generates vectors "
+                f"of size {vector_size}: set EMBEDDING_MODEL to the model used to load it, or reload it"
+            )
+        existing_rerank_size = self.rerank_vector_size()
+        if existing_rerank_size == rerank_vector_size:
+            return
+        if existing_rerank_size is None:
+            raise ValueError(
+                "The vector store has no rerank vectors: unset RERANK_EMBEDDING_MODEL, or reload the store with it"
+            )
+        if rerank_vector_size is None:
+            raise ValueError(
+                f"The vector store has rerank vectors of size {existing_rerank_size}: set RERANK_EMBEDDING_MODEL "
+                "to the model used to load them"
+            )
+        raise ValueError(
+            f"The vector store has rerank vectors of size {existing_rerank_size}, but the rerank model generates "
+            f"vectors of size {rerank_vector_size}: set RERANK_EMBEDDING_MODEL to the model used to load it, "
+            "or reload it"
+        )
+
+    @abstractmethod
+    def upsert(
+        self, ids: List[str], vectors: np.ndarray, payloads: List[dict], rerank_vectors: Optional[np.ndarray] = None
+    ) -> None:
+        """`rerank_vectors` are required when the store was created with a `rerank_vector_size`."""
+
+    @abstractmethod
+    def upsert_cliques(self, cliques: List[dict]) -> None:
+        """Store clique documents with their `curie`, `label`, `synonyms` and `types`."""
+
+    @abstractmethod
+    def upsert_centroids(self, curies: List[str], vectors: np.ndarray, payloads: List[dict]) -> None:
+        """Store the mean vector of the synonyms of each CURIE, replacing its previous centroid."""
+
+    @abstractmethod
+    def delete_source(self, source: str, keep_hash: Optional[str] = None) -> None:
+        """Delete the points loaded from a source, except the ones loaded from its version with the `keep_hash` hash."""
+
+    @abstractmethod
+    async def search_hits(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        """Get the best `fetch_limit` synonyms of each query, ordered by decreasing score, ignoring the offset."""
+
+    @abstractmethod
+    async def search_centroids(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        """Get the best `fetch_limit` concepts of each query by the similarity to their centroid."""
+
+    @abstractmethod
+    async def get_cliques(self, curies: List[str], fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        """Get the clique documents of the CURIEs, with only their `curie` and `fields` when fields are given."""
+
+    async def search(self, queries: List[VectorQuery]) -> List[List[Hit]]:
+        """Get `limit` distinct CURIEs for each query, after skipping `offset` CURIEs.
+
+        Synonyms are over-fetched and deduplicated, only the queries that did not get enough distinct CURIEs
+        are searched again with a larger limit.
+        """
+        results: Dict[int, List[Hit]] = {i: [] for i, query in enumerate(queries) if query.limit <= 0}
+        pending = [i for i in range(len(queries)) if i not in results]
+        overfetch = self.overfetch
+        while pending:
+            fetch_limits = [min((queries[i].offset + queries[i].limit) * overfetch, self.max_fetch) for i in pending]
+            with timed("search"):
+                batch_hits = await self.search_hits([queries[i] for i in pending], fetch_limits)
+            next_pending = []
+            with timed("dedup"):
+                for i, fetch_limit, hits in zip(pending, fetch_limits, batch_hits):
+                    query = queries[i]
+                    deduped = dedup_hits(hits)
+                    if len(deduped) < query.offset + query.limit and len(hits) == fetch_limit < self.max_fetch:
+                        next_pending.append(i)
+                    else:
+                        results[i] = deduped[query.offset : query.offset + query.limit]
+            pending = next_pending
+            overfetch *= 4
+        return [results[i] for i in range(len(queries))]
+
+    async def search_two_stage(self, queries: List[VectorQuery]) -> List[List[Hit]]:
+        """Search the index of centroids (one vector per concept) to get candidate concepts,
+        then rescore the synonyms of the candidates only, to rank them by their best synonym like `search()`.
+        """
+        fetch_limits = [
+            min((query.offset + query.limit) * self.centroid_candidates, self.max_fetch) for query in queries
+        ]
+        with timed("centroids"):
+            batch_candidates = await self.search_centroids(queries, fetch_limits)
+        rescore_queries = []
+        for query, candidates in zip(queries, batch_candidates):
+            curies = [hit.curie for hit in candidates]
+            rescore_queries.append(
+                query._replace(
+                    # Without candidates the query has no results, an empty CURIEs filter would search everything
+                    limit=query.limit if curies else 0,
+                    filters=(query.filters or SearchFilters())._replace(curies=curies),
+                )
+            )
+        return await self.search(rescore_queries)
+
+    async def search_cascade(
+        self,
+        queries: List[VectorQuery],
+        rerank_vectors: List[np.ndarray],
+        candidates: List[int],
+        two_stage: bool = False,
+    ) -> List[List[Hit]]:
+        """Get the best `candidates` concepts of each query with the vectors of the fast model, then rank them by
+        the similarity of their best synonym with the `rerank_vectors` of the query, embedded by the rerank model.
+
+        The rerank vectors are more accurate but too slow to search the whole index, only the synonyms of
+        the candidates are compared to them.
+        """
+        candidate_queries = [
+            query._replace(offset=0, limit=max(width, query.offset + query.limit))
+            for query, width in zip(queries, candidates)
+        ]
+        batch_candidates = await (self.search_two_stage if two_stage else self.search)(candidate_queries)
+        rerank_queries = []
+        for query, rerank_vector, hits in zip(queries, rerank_vectors, batch_candidates):
+            curies = [hit.curie for hit in hits]
+            rerank_queries.append(
+                query._replace(
+                    vector=rerank_vector,
+                    rerank=True,
+                    limit=query.limit if curies else 0,
+                    filters=(query.filters or SearchFilters())._replace(curies=curies),
+                )
+            )
+        return await self.search(rerank_queries)
+
+    def build_indexes(self, **options) -> None:
+        """Build the search indexes after loading, for backends that do not maintain them while inserting."""
+
+    def publish(self, **options) -> None:
+        """Serve the version loaded since `create()`, for backends that load new versions next to the one searched."""
+
+    def versions(self) -> List[str]:
+        """Versions of the data kept in the store, none for backends that recreate their tables in place."""
+        return []
+
+    def rollback(self) -> str:
+        """Serve the previous version again, returns its name."""
+        raise NotImplementedError(f"{type(self).__name__} does not keep the previous versions of the data")
+
+    def close(self) -> None:
+        pass
+
+
+class QdrantBackend(VectorBackend):
+    """Qdrant server (or local Qdrant stored in `path`), clique documents are stored in a vectorless collection."""
+
+    def __init__(
+        self,
+        host: str = "qdrant",
+        path: Optional[str] = None,
+        search_params: Optional[SearchParams] = None,
+        named_vectors: bool = False,
+    ):
+        """The points of collections loaded with a rerank model have `named_vectors`, the fast and rerank vectors."""
+        self.client_args = {"path": path} if path else {"host": host, "prefer_grpc": True}
+        # Size of the HNSW candidates list at query time (higher is more accurate but slower), and when the
+        # collection is quantized, if results are rescored with the original vectors and how many more to rescore
+        self.search_params = search_params or SearchParams(
+            hnsw_ef=int(os.environ["SEARCH_HNSW_EF"]) if os.getenv("SEARCH_HNSW_EF") else None,
+            quantization=QuantizationSearchParams(
+                rescore=os.getenv("SEARCH_RESCORE", "true").lower() == "true",
+                oversampling=float(os.getenv("SEARCH_OVERSAMPLING", "2.0")),
+            ),
+        )
+        self._client = None
+        self._async_client = None
+        # Version written by the ingestion methods, set by `create()`, the served one (through the aliases) if None
+        self.version: Optional[str] = None
+        self.named_vectors = named_vectors
+
+    @property
+    def client(self) -> QdrantClient:
+        if self._client is None:
+            self._client = QdrantClient(**self.client_args)
+        return self._client
+
+    @property
+    def async_client(self) -> AsyncQdrantClient:
+        if self._async_client is None:
+            self._async_client = AsyncQdrantClient(**self.client_args)
+        return self._async_client
+
+    def _name(self, alias: str) -> str:
+        """Collection written by the ingestion methods: the one of the version being loaded, or the served one."""
+        return f"{alias}{VERSION_SEPARATOR}{self.version}" if self.version else alias
+
+    def _collection_names(self) -> List[str]:
+        return [c.name for c in self.client.get_collections().collections]
+
+    def _aliases(self) -> Dict[str, str]:
+        return {alias.alias_name: alias.collection_name for alias in self.client.get_aliases().aliases}
+
+    def versions(self) -> List[str]:
+        """Versions of the data in the store, sorted by name (timestamps by default, so from the oldest)."""
+        prefix = f"{COLLECTION_NAME}{VERSION_SEPARATOR}"
+        return sorted(name[len(prefix) :] for name in self._collection_names() if name.startswith(prefix))
+
+    def served_version(self) -> Optional[str]:
+        """Version searched by the API through the aliases, None if the store has no versions yet."""
+        collection_name = self._aliases().get(COLLECTION_NAME)
+        if collection_name is None:
+            return None
+        return collection_name[len(COLLECTION_NAME) + len(VERSION_SEPARATOR) :]
+
+    def _vectors_config(self) -> Union[None, VectorParams, Dict[str, VectorParams]]:
+        name = self._name(COLLECTION_NAME)
+        if name not in self._collection_names() and name not in self._aliases():
+            return None
+        return self.client.get_collection(name).config.params.vectors
+
+    def vector_size(self) -> Optional[int]:
+        vectors = self._vectors_config()
+        if isinstance(vectors, dict):
+            return vectors[FAST_VECTOR].size
+        return vectors.size if vectors is not None else None
+
+    def rerank_vector_size(self) -> Optional[int]:
+        vectors = self._vectors_config()
+        return vectors[RERANK_VECTOR].size if isinstance(vectors, dict) and RERANK_VECTOR in vectors else None
+
+    def _query_vector(self, query: VectorQuery) -> Union[List[float], NamedVector]:
+        if not self.named_vectors:
+            return query.vector.tolist()
+        return NamedVector(name=RERANK_VECTOR if query.rerank else FAST_VECTOR, vector=query.vector.tolist())
+
+    def create(
+        self,
+        vector_size: int,
+        recreate: bool = True,
+        quantization: Optional[str] = None,
+        on_disk: bool = False,
+        hnsw_m: Optional[int] = None,
+        hnsw_ef_construct: Optional[int] = None,
+        version: Optional[str] = None,
+        indexing_threads: Optional[int] = None,
+        rerank_vector_size: Optional[int] = None,
+        **options,
+    ) -> None:
+        """Scalar quantization divides the memory used by vectors by 4, and binary by 32.
+
+        With `on_disk` the original vectors are stored on disk, and only read to rescore the results of the search.
+
+        When `recreate` is True the collections of a new `version` (a timestamp by default) are created, and are
+        only searched once published, an existing version is refused so the served collections are never dropped.
+        When it is False the collections of `version` are kept if they exist, or without version the served
+        collections are written in place.
+        `indexing_threads` limits the threads Qdrant uses to build the HNSW index, to leave CPU to the searches.
+
+        With a `rerank_vector_size` the synonyms points store a second vector embedded with the rerank model,
+        they are only compared to the queries for the candidates of a cascade search, so they are not indexed.
+        """
+        if recreate and version in self.versions():
+            raise ValueError(f"Version {version} already exists, recreating it would drop the collections it serves")
+        self.version = version or (time.strftime("%Y%m%d%H%M%S") if recreate else None)
+        self.named_vectors = rerank_vector_size is not None
+        name = self._name(COLLECTION_NAME)
+        if not recreate and (name in self._collection_names() or name in self._aliases()):
+            self.check_vector_size(vector_size, rerank_vector_size)
+            return
+        print(f"Loading version {self.version}, searched once it is published")
+        hnsw_config = HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct, max_indexing_threads=indexing_threads)
+        vectors_config = VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=on_disk)
+        if rerank_vector_size is not None:
+            # The rerank vectors of a few hundred candidates are read per query, they can stay on disk,
+            # and m=0 disables the HNSW graph of a vector
+            vectors_config = {
+                FAST_VECTOR: vectors_config,
+                RERANK_VECTOR: VectorParams(
+                    size=rerank_vector_size, distance=Distance.COSINE, on_disk=True, hnsw_config=HnswConfigDiff(m=0)
+                ),
+            }
+        self.client.recreate_collection(
+            collection_name=self._name(COLLECTION_NAME),
+            vectors_config=vectors_config,
+            hnsw_config=hnsw_config,
+            quantization_config=quantization_config(quantization),
+        )
+        # Clique documents are only retrieved by ID, they do not need vectors
+        self.client.recreate_collection(
+            collection_name=self._name(CLIQUES_COLLECTION_NAME),
+            vectors_config={},
+        )
+        self.client.recreate_collection(
+            collection_name=self._name(CENTROIDS_COLLECTION_NAME),
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=on_disk),
+            hnsw_config=hnsw_config,
+            quantization_config=quantization_config(quantization),
+        )
+        # Index the fields used to filter lookups, so filtering is done during the HNSW search,
+        # and the source file used to delete the points of a file when it changes
+        for collection_name in [COLLECTION_NAME, CENTROIDS_COLLECTION_NAME]:
+            for field_name in ["curie", "prefix", "types", "source", "source_hash"]:
+                self.client.create_payload_index(
+                    collection_name=self._name(collection_name),
+                    field_name=field_name,
+                    field_schema=PayloadSchemaType.KEYWORD,
+                )
+        for field_name in ["source", "source_hash"]:
+            self.client.create_payload_index(
+                collection_name=self._name(CLIQUES_COLLECTION_NAME),
+                field_name=field_name,
+                field_schema=PayloadSchemaType.KEYWORD,
+            )
+
+    def upsert(
+        self, ids: List[str], vectors: np.ndarray, payloads: List[dict], rerank_vectors: Optional[np.ndarray] = None
+    ) -> None:
+        if self.named_vectors:
+            batch_vectors = {FAST_VECTOR: vectors.tolist(), RERANK_VECTOR: rerank_vectors.tolist()}
+        else:
+            batch_vectors = vectors.tolist()
+        self.client.upsert(
+            collection_name=self._name(COLLECTION_NAME),
+            points=Batch(ids=ids, vectors=batch_vectors, payloads=payloads),
+        )
+
+    def upsert_cliques(self, cliques: List[dict]) -> None:
+        self.client.upsert(
+            collection_name=self._name(CLIQUES_COLLECTION_NAME),
+            points=Batch(ids=[clique_id(clique["curie"]) for clique in cliques], vectors={}, payloads=cliques),
+        )
+
+    def upsert_centroids(self, curies: List[str], vectors: np.ndarray, payloads: List[dict]) -> None:
+        self.client.upsert(
+            collection_name=self._name(CENTROIDS_COLLECTION_NAME),
+            points=Batch(ids=[clique_id(curie) for curie in curies], vectors=vectors.tolist(), payloads=payloads),
+        )
+
+    def delete_source(self, source: str, keep_hash: Optional[str] = None) -> None:
+        for collection_name in QDRANT_ALIASES:
+            self.client.delete(
+                collection_name=self._name(collection_name),
+                points_selector=FilterSelector(
+                    filter=Filter(
+                        must=[FieldCondition(key="source", match=MatchValue(value=source))],
+                        must_not=[FieldCondition(key="source_hash", match=MatchValue(value=keep_hash))]
+                        if keep_hash
+                        else None,
+                    )
+                ),
+            )
+
+    def publish(self, max_shrink: float = 0.5, timeout: float = 3600, **options) -> None:
+        """Point the aliases to the collections of the loaded version once they are indexed and pass sanity checks.
+
+        The publication is refused if the new version has less than `1 - max_shrink` times the synonyms of the served
+        one. The previous version is kept to roll back to, older ones are deleted.
+        """
+        if self.version is None or self.version == self.served_version():
+            # The served collections were written in place
+            return
+        for alias in QDRANT_ALIASES:
+            self._wait_indexed(self._name(alias), timeout)
+        self._check_version(max_shrink)
+        previous = self.served_version()
+        self._swap_aliases(self.version)
+        print(f"Serving version {self.version}" + (f", version {previous} kept for rollback" if previous else ""))
+        for version in self.versions():
+            if version not in (self.version, previous):
+                print(f"Deleting version {version}")
+                for alias in QDRANT_ALIASES:
+                    self.client.delete_collection(f"{alias}{VERSION_SEPARATOR}{version}")
+
+    def rollback(self) -> str:
+        served = self.served_version()
+        previous = [version for version in self.versions() if served is None or version < served]
+        if not previous:
+            raise ValueError(f"No version older than {served} to roll back to")
+        self._swap_aliases(previous[-1])
+        return previous[-1]
+
+    def _wait_indexed(self, collection_name: str, timeout: float) -> None:
+        deadline = time.time() + timeout
+        while True:
+            status = self.client.get_collection(collection_name).status
+            if status == CollectionStatus.GREEN:
+                return
+            if status == CollectionStatus.RED:
+                raise ValueError(f"Collection {collection_name} failed to build, not publishing it")
+            if time.time() > deadline:
+                raise TimeoutError(f"Collection {collection_name} still indexing after {timeout}s, not publishing it")
+            time.sleep(5)
+
+    def _check_version(self, max_shrink: float) -> None:
+        """Raise a ValueError if the loaded version is empty, much smaller than the served one or cannot be searched."""
+        name = self._name(COLLECTION_NAME)
+        count = self.client.count(name, exact=True).count
+        if count == 0:
+            raise ValueError(f"Version {self.version} has no synonyms, not publishing it")
+        if COLLECTION_NAME in self._collection_names() or COLLECTION_NAME in self._aliases():
+            served_count = self.client.count(COLLECTION_NAME, exact=True).count
+            if count < served_count * (1 - max_shrink):
+                raise ValueError(
+                    f"Version {self.version} has {count} synonyms, against {served_count} for the served version, "
+                    "not publishing it"
+                )
+        # A synonym is found by its own vector, and its clique document is loaded
+        points, _ = self.client.scroll(name, limit=1, with_vectors=True)
+        vector = points[0].vector
+        if isinstance(vector, dict):
+            vector = NamedVector(name=FAST_VECTOR, vector=vector[FAST_VECTOR])
+        hits = self.client.search(name, query_vector=vector, limit=1, search_params=self.search_params)
+        if not hits or hits[0].score < 0.99:
+            raise ValueError(f"Version {self.version} does not find its own synonyms, not publishing it")
+        curie = points[0].payload["curie"]
+        if not self.client.retrieve(self._name(CLIQUES_COLLECTION_NAME), ids=[clique_id(curie)], with_payload=False):
+            raise ValueError(f"Version {self.version} has no clique document for {curie}, not publishing it")
+
+    def _swap_aliases(self, version: str) -> None:
+        collection_names = self._collection_names()
+        aliases = self._aliases()
+        operations = []
+        for alias in QDRANT_ALIASES:
+            if alias in collection_names:
+                # Collection loaded before the data was versioned, it has to be dropped to create the alias
+                print(f"Deleting the unversioned collection {alias}, replaced by an alias")
+                self.client.delete_collection(alias)
+            elif alias in aliases:
+                operations.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)))
+            operations.append(
+                CreateAliasOperation(
+                    create_alias=CreateAlias(collection_name=f"{alias}{VERSION_SEPARATOR}{version}", alias_name=alias)
+                )
+            )
+        # All the aliases are switched in one atomic operation,
+        # so searches never mix the synonyms of one version with the cliques of another
+        self.client.update_collection_aliases(change_aliases_operations=operations)
+
+    async def search(self, queries: List[VectorQuery]) -> List[List[Hit]]:
+        if len(queries) != 1 or queries[0].limit <= 0:
+            # There is no batch version of the grouped search
+            return await super().search(queries)
+        query = queries[0]
+        # Group the synonyms hits by CURIE, so we get `limit` distinct concepts with the score of their best synonym
+        with timed("search"):
+            groups = await self.async_client.search_groups(
+                collection_name=COLLECTION_NAME,
+                query_vector=self._query_vector(query),
+                query_filter=qdrant_filter(query.filters),
+                search_params=self.search_params,
+                group_by="curie",
+                group_size=1,
+                limit=query.offset + query.limit,
+                with_payload=HIT_PAYLOAD_FIELDS,
+            )
+        return [[to_hit(group.hits[0]) for group in groups.groups[query.offset :]]]
+
+    async def search_hits(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        return await self._search_batch(
+            COLLECTION_NAME, [self._query_vector(query) for query in queries], queries, fetch_limits
+        )
+
+    async def search_centroids(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        # Centroids are the mean of the fast vectors only
+        return await self._search_batch(
+            CENTROIDS_COLLECTION_NAME, [query.vector.tolist() for query in queries], queries, fetch_limits
+        )
+
+    async def _search_batch(
+        self,
+        collection_name: str,
+        vectors: List[Union[List[float], NamedVector]],
+        queries: List[VectorQuery],
+        fetch_limits: List[int],
+    ) -> List[List[Hit]]:
+        batch_hits = await self.async_client.search_batch(
+            collection_name=collection_name,
+            requests=[
+                SearchRequest(
+                    vector=vector,
+                    filter=qdrant_filter(query.filters),
+                    params=self.search_params,
+                    limit=fetch_limit,
+                    with_payload=HIT_PAYLOAD_FIELDS,
+                )
+                for vector, query, fetch_limit in zip(vectors, queries, fetch_limits)
+            ],
+        )
+        return [[to_hit(point) for point in points] for points in batch_hits]
+
+    async def get_cliques(self, curies: List[str], fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        records = await self.async_client.retrieve(
+            collection_name=CLIQUES_COLLECTION_NAME,
+            ids=[clique_id(curie) for curie in curies],
+            # Only the selected fields are sent by Qdrant, synonyms are most of the size of the documents
+            with_payload=["curie", *(CLIQUE_FIELDS if fields is None else fields)],
+            with_vectors=False,
+        )
+        return {record.payload["curie"]: record.payload for record in records}
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def quantization_config(quantization: Optional[str]) -> Optional[QuantizationConfig]:
+    """Quantized vectors are kept in RAM for the search, and the original vectors are used to rescore the results."""
+    if quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True),
+        )
+    if quantization == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    if quantization:
+        raise ValueError(f"Unknown quantization {quantization}, use scalar or binary")
+    return None
+
+
+def qdrant_filter(filters: Optional[SearchFilters]) -> Optional[Filter]:
+    """Translate the search filters to a Qdrant filter on the indexed payload fields."""
+    if filters is None:
+        return None
+    must = []
+    must_not = []
+    if filters.types:
+        must.append(FieldCondition(key="types", match=MatchAny(any=filters.types)))
+    if filters.prefixes:
+        must.append(FieldCondition(key="prefix", match=MatchAny(any=filters.prefixes)))
+    if filters.sources:
+        must.append(FieldCondition(key="source", match=MatchAny(any=filters.sources)))
+    if filters.curies:
+        must.append(FieldCondition(key="curie", match=MatchAny(any=filters.curies)))
+    if filters.exclude_prefixes:
+        must_not.append(FieldCondition(key="prefix", match=MatchAny(any=filters.exclude_prefixes)))
+    if not must and not must_not:
+        return None
+    return Filter(must=must or None, must_not=must_not or None)
+
+
+def to_hit(point) -> Hit:
+    return Hit(point.payload["curie"], point.payload.get("embedded_label", ""), point.score, point.payload)
+
+
+class PgvectorBackend(VectorBackend):
+    """PostgreSQL with the pgvector extension, one row per synonym, a table of clique documents and one of centroids.
+
+    Uses the `label_id`, `label` and `dictionary` columns of the PubDictionaries table for the CURIE,
+    embedded label and source of the synonyms.
+    """
+
+    def __init__(
+        self,
+        conninfo: str = PG_CONNECT,
+        table: str = "pubdictionaries_embeddings",
+        index: str = "hnsw",
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        iterative_scan: Optional[str] = None,
+        max_connections: int = 4,
+    ):
+        if index not in ("hnsw", "ivfflat"):
+            raise ValueError(f"Unknown pgvector index {index}, use hnsw or ivfflat")
+        self.conninfo = conninfo
+        self.table = table
+        self.cliques_table = f"{table}_cliques"
+        self.centroids_table = f"{table}_centroids"
+        self.index = index
+        # Query-time settings of the ANN indexes, applied to every connection of the pool
+        self.settings = {
+            "hnsw.ef_search": ef_search,
+            "ivfflat.probes": probes,
+            # pgvector >= 0.8, keep scanning the index until enough rows match the filters (`relaxed_order`)
+            f"{index}.iterative_scan": iterative_scan,
+        }
+        self.max_connections = max_connections
+        self._conn = None
+        self._pool = None
+        self._write_pool = None
+
+    @property
+    def conn(self) -> psycopg.Connection:
+        if self._conn is None:
+            self._conn = psycopg.connect(self.conninfo)
+            self._conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            register_vector(self._conn)
+        return self._conn
+
+    @property
+    def write_pool(self) -> ConnectionPool:
+        """Connections used to write batches, so sources can be loaded in parallel from multiple threads."""
+        if self._write_pool is None:
+            self.conn  # Make sure the vector extension exists before registering its types
+            self._write_pool = ConnectionPool(
+                self.conninfo, min_size=1, max_size=self.max_connections, configure=configure_vector, open=True
+            )
+        return self._write_pool
+
+    async def pool(self) -> AsyncConnectionPool:
+        if self._pool is None:
+            self._pool = AsyncConnectionPool(self.conninfo, configure=self._configure, open=False)
+            await self._pool.open()
+        return self._pool
+
+    async def _configure(self, conn: psycopg.AsyncConnection) -> None:
+        await register_vector_async(conn)
+        for name, value in self.settings.items():
+            if value is not None:
+                await conn.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+        await conn.commit()
+
+    def vector_size(self) -> Optional[int]:
+        # The dimensions of a vector column are its type modifier
+        row = self.conn.execute(
+            "SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'embedding'",
+            (self.table,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def create(self, vector_size: int, recreate: bool = True, defer_indexes: bool = False, **options) -> None:
+        """With `defer_indexes` the secondary indexes are dropped, and only built by `build_indexes()` after loading."""
+        if options.get("rerank_vector_size"):
+            raise ValueError("Rerank vectors are only stored by Qdrant, unset RERANK_EMBEDDING_MODEL")
+        if not recreate:
+            self.check_vector_size(vector_size)
+        with self.conn.cursor() as cursor:
+            if recreate:
+                cursor.execute(f"DROP TABLE IF EXISTS {self.table}, {self.cliques_table}, {self.centroids_table}")
+            cursor.execute(
+                f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                id TEXT PRIMARY KEY,
+                label_id TEXT,
+                label TEXT,
+                dictionary TEXT,
+                prefix TEXT,
+                types TEXT[],
+                source_hash TEXT,
+                embedding vector({vector_size})
+            )
+            """
+            )
+            cursor.execute(
+                f"""
+            CREATE TABLE IF NOT EXISTS {self.cliques_table} (
+                curie TEXT PRIMARY KEY,
+                dictionary TEXT,
+                source_hash TEXT,
+                document JSONB
+            )
+            """
+            )
+            cursor.execute(
+                f"""
+            CREATE TABLE IF NOT EXISTS {self.centroids_table} (
+                curie TEXT PRIMARY KEY,
+                dictionary TEXT,
+                prefix TEXT,
+                types TEXT[],
+                source_hash TEXT,
+                count INTEGER,
+                embedding vector({vector_size})
+            )
+            """
+            )
+            if defer_indexes:
+                for index in ["label_id", "dictionary", "embedding_hnsw", "embedding_ivfflat"]:
+                    cursor.execute(f"DROP INDEX IF EXISTS {self.table}_{index}")
+                for index in ["embedding_hnsw", "embedding_ivfflat"]:
+                    cursor.execute(f"DROP INDEX IF EXISTS {self.centroids_table}_{index}")
+                cursor.execute(f"DROP INDEX IF EXISTS {self.cliques_table}_dictionary")
+            else:
+                self._create_btree_indexes(cursor)
+        self.conn.commit()
+
+    def _create_btree_indexes(self, cursor: psycopg.Cursor) -> None:
+        # Used to filter by dictionary, to delete sources and to get the labels of an ID
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_label_id ON {self.table} (label_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_dictionary ON {self.table} (dictionary)")
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.cliques_table}_dictionary ON {self.cliques_table} (dictionary)"
+        )
+
+    def build_indexes(
+        self,
+        lists: Optional[int] = None,
+        hnsw_m: Optional[int] = None,
+        hnsw_ef_construct: Optional[int] = None,
+        **options,
+    ) -> None:
+        """Build the HNSW or IVFFlat index with cosine distance on the embeddings, after the table has been loaded.
+
+        IVFFlat clusters the rows present when the index is built, so it should be rebuilt after large loads.
+        """
+        with self.conn.cursor() as cursor:
+            self._create_btree_indexes(cursor)
+            for table in [self.table, self.centroids_table]:
+                self._build_vector_index(cursor, table, lists, hnsw_m, hnsw_ef_construct)
+        self.conn.commit()
+
+    def _build_vector_index(
+        self,
+        cursor: psycopg.Cursor,
+        table: str,
+        lists: Optional[int],
+        hnsw_m: Optional[int],
+        hnsw_ef_construct: Optional[int],
+    ) -> None:
+        other = "ivfflat" if self.index == "hnsw" else "hnsw"
+        cursor.execute(f"DROP INDEX IF EXISTS {table}_embedding_{other}")
+        if self.index == "hnsw":
+            params = {"m": hnsw_m, "ef_construction": hnsw_ef_construct}
+        else:
+            if lists is None:
+                # Recommended by pgvector: rows / 1000 up to 1M rows, sqrt(rows) above
+                rows = cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+                lists = max(rows // 1000, 1) if rows <= 1_000_000 else int(np.sqrt(rows))
+            # The lists are computed from the rows in the table, rebuild the index with the new rows
+            cursor.execute(f"DROP INDEX IF EXISTS {table}_embedding_ivfflat")
+            params = {"lists": lists}
+        with_params = ", ".join(f"{key} = {int(value)}" for key, value in params.items() if value is not None)
+        with_clause = f"WITH ({with_params})" if with_params else ""
+        print(f"Building the {self.index} index of {table} {with_clause}")
+        cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS {table}_embedding_{self.index} ON {table}
+            USING {self.index} (embedding vector_cosine_ops) {with_clause}"""
+        )
+        cursor.execute(f"ANALYZE {table}")
+
+    def upsert(
+        self, ids: List[str], vectors: np.ndarray, payloads: List[dict], rerank_vectors: Optional[np.ndarray] = None
+    ) -> None:
+        """Binary COPY the rows in a temporary table, and merge them in the table with one INSERT."""
+        staging = f"{self.table}_staging"
+        with self.write_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {self.table}) ON COMMIT DELETE ROWS")
+            with cursor.copy(
+                f"""COPY {staging} (id, label_id, label, dictionary, prefix, types, source_hash, embedding)
+                FROM STDIN WITH (FORMAT BINARY)"""
+            ) as copy:
+                copy.set_types(["text", "text", "text", "text", "text", "text[]", "text", "vector"])
+                for id, vector, payload in zip(ids, vectors, payloads):
+                    copy.write_row(
+                        (
+                            id,
+                            str(payload["curie"]),
+                            str(payload["embedded_label"]),
+                            payload["source"],
+                            payload.get("prefix"),
+                            payload.get("types", []),
+                            payload.get("source_hash"),
+                            vector,
+                        )
+                    )
+            # A batch can contain the same label twice, which cannot be updated twice by the same INSERT
+            cursor.execute(
+                f"""INSERT INTO {self.table} SELECT DISTINCT ON (id) * FROM {staging}
+                ON CONFLICT (id) DO UPDATE SET label_id = EXCLUDED.label_id, label = EXCLUDED.label,
+                    dictionary = EXCLUDED.dictionary, prefix = EXCLUDED.prefix, types = EXCLUDED.types,
+                    source_hash = EXCLUDED.source_hash, embedding = EXCLUDED.embedding"""
+            )
+
+    def upsert_cliques(self, cliques: List[dict]) -> None:
+        with self.write_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.executemany(
+                f"""INSERT INTO {self.cliques_table} (curie, dictionary, source_hash, document) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (curie) DO UPDATE SET dictionary = EXCLUDED.dictionary,
+                    source_hash = EXCLUDED.source_hash, document = EXCLUDED.document""",
+                [(clique["curie"], clique.get("source"), clique.get("source_hash"), Jsonb(clique)) for clique in cliques],
+            )
+
+    def upsert_centroids(self, curies: List[str], vectors: np.ndarray, payloads: List[dict]) -> None:
+        with self.write_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.executemany(
+                f"""INSERT INTO {self.centroids_table} (curie, dictionary, prefix, types, source_hash, count, embedding)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (curie) DO UPDATE SET dictionary = EXCLUDED.dictionary, prefix = EXCLUDED.prefix,
+                    types = EXCLUDED.types, source_hash = EXCLUDED.source_hash, count = EXCLUDED.count,
+                    embedding = EXCLUDED.embedding""",
+                [
+                    (
+                        curie,
+                        payload.get("source"),
+                        payload.get("prefix"),
+                        payload.get("types", []),
+                        payload.get("source_hash"),
+                        payload.get("count"),
+                        vector,
+                    )
+                    for curie, vector, payload in zip(curies, vectors, payloads)
+                ],
+            )
+
+    def delete_source(self, source: str, keep_hash: Optional[str] = None) -> None:
+        with self.write_pool.connection() as conn, conn.cursor() as cursor:
+            for table in [self.table, self.cliques_table, self.centroids_table]:
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE dictionary = %s AND source_hash IS DISTINCT FROM %s",
+                    (source, keep_hash),
+                )
+
+    async def search_hits(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        return await self._search(self.table, "label_id", "label", queries, fetch_limits)
+
+    async def search_centroids(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        return await self._search(self.centroids_table, "curie", "''", queries, fetch_limits)
+
+    async def _search(
+        self, table: str, curie_column: str, label_column: str, queries: List[VectorQuery], fetch_limits: List[int]
+    ) -> List[List[Hit]]:
+        pool = await self.pool()
+        results = []
+        async with pool.connection() as conn:
+            for query, fetch_limit in zip(queries, fetch_limits):
+                where, params = pg_where(query.filters, curie_column)
+                cursor = await conn.execute(
+                    f"""SELECT {curie_column}, {label_column}, dictionary, 1 - (embedding <=> %s) AS score FROM {table}
+                    {where} ORDER BY embedding <=> %s LIMIT %s""",
+                    [query.vector, *params, query.vector, fetch_limit],
+                )
+                results.append(
+                    [
+                        Hit(curie, label, score, {"curie": curie, "embedded_label": label, "source": dictionary})
+                        for curie, label, dictionary, score in await cursor.fetchall()
+                    ]
+                )
+        return results
+
+    async def get_cliques(self, curies: List[str], fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        pool = await self.pool()
+        if fields is None:
+            document, params = "document", []
+        else:
+            # Only read the selected keys of the documents, instead of sending the synonyms that are not returned
+            keys = ["curie", *fields]
+            pairs = ", ".join(["%s::text, document -> %s::text"] * len(keys))
+            document = f"jsonb_strip_nulls(jsonb_build_object({pairs}))"
+            params = [param for key in keys for param in (key, key)]
+        async with pool.connection() as conn:
+            cursor = await conn.execute(
+                f"SELECT curie, {document} FROM {self.cliques_table} WHERE curie = ANY(%s)", [*params, curies]
+            )
+            cliques = {curie: document for curie, document in await cursor.fetchall()}
+            missing = [curie for curie in curies if curie not in cliques]
+            if missing:
+                # Dictionaries do not have clique documents, use the labels of the ID as synonyms
+                cursor = await conn.execute(
+                    f"SELECT label_id, array_agg(DISTINCT label) FROM {self.table} WHERE label_id = ANY(%s) GROUP BY label_id",
+                    (missing,),
+                )
+                for label_id, labels in await cursor.fetchall():
+                    cliques[label_id] = project(
+                        {"curie": label_id, "label": labels[0], "synonyms": labels, "types": []}, fields
+                    )
+        return cliques
+
+    def close(self) -> None:
+        if self._write_pool is not None:
+            self._write_pool.close()
+            self._write_pool = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def configure_vector(conn: psycopg.Connection) -> None:
+    register_vector(conn)
+    # Leave the connection idle, as expected by the pool
+    conn.commit()
+
+
+def pg_where(filters: Optional[SearchFilters], curie_column: str = "label_id"):
+    """Translate the search filters to a SQL WHERE clause and its parameters."""
+    if filters is None:
+        return "", []
+    conditions = []
+    params: list = []
+    if filters.types:
+        conditions.append("types && %s")
+        params.append(filters.types)
+    if filters.prefixes:
+        conditions.append("prefix = ANY(%s)")
+        params.append(filters.prefixes)
+    if filters.exclude_prefixes:
+        # Rows without prefix (e.g. PubDictionaries synonyms) are not excluded, NOT (NULL = ANY(...)) would be NULL
+        conditions.append("(prefix IS NULL OR prefix <> ALL(%s))")
+        params.append(filters.exclude_prefixes)
+    if filters.sources:
+        conditions.append("dictionary = ANY(%s)")
+        params.append(filters.sources)
+    if filters.curies:
+        conditions.append(f"{curie_column} = ANY(%s)")
+        params.append(filters.curies)
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+class NumpyBackend(VectorBackend):
+    """In-process flat index, with the normalized vectors in a memory-mapped file and an exact vectorized search.
+
+    Workers opening the same index share the vectors through the OS page cache instead of copying them.
+    The index is append-only: reload it from scratch instead of deleting sources.
+    """
+
+    # Number of vectors scored at once, to bound the memory used by the search
+    chunk_size = 1_000_000
+
+    def __init__(self, path: str = "data/index"):
+        self.path = path
+        self._index = None
+        # Vectors and payloads are appended to 2 files, which need to stay aligned when uploading from threads
+        self._write_lock = threading.Lock()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def create(self, vector_size: int, recreate: bool = True, **options) -> None:
+        if options.get("rerank_vector_size"):
+            raise ValueError("Rerank vectors are only stored by Qdrant, unset RERANK_EMBEDDING_MODEL")
+        if recreate and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        if os.path.exists(self._file("meta.json")):
+            self.check_vector_size(vector_size)
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file("meta.json"), "w") as f:
+            json.dump({"vector_size": vector_size}, f)
+        self._index = None
+
+    def vector_size(self) -> Optional[int]:
+        if not os.path.exists(self._file("meta.json")):
+            return None
+        with open(self._file("meta.json")) as f:
+            return json.load(f)["vector_size"]
+
+    def upsert(
+        self, ids: List[str], vectors: np.ndarray, payloads: List[dict], rerank_vectors: Optional[np.ndarray] = None
+    ) -> None:
+        self._append("points", vectors, [{"id": id, **payload} for id, payload in zip(ids, payloads)])
+
+    def upsert_centroids(self, curies: List[str], vectors: np.ndarray, payloads: List[dict]) -> None:
+        # The last centroid appended for a CURIE replaces the previous ones when the index is loaded
+        self._append("centroids", vectors, [{**payload, "curie": curie} for curie, payload in zip(curies, payloads)])
+
+    def _append(self, name: str, vectors: np.ndarray, payloads: List[dict]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # Store normalized vectors, so the cosine similarity is a dot product
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        with self._write_lock:
+            with open(self._file(f"{name}.f32"), "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._file(f"{name}.jsonl"), "a") as f:
+                for payload in payloads:
+                    f.write(json.dumps(payload) + "\n")
+            self._index = None
+
+    def upsert_cliques(self, cliques: List[dict]) -> None:
+        with self._write_lock:
+            with open(self._file("cliques.jsonl"), "a") as f:
+                for clique in cliques:
+                    f.write(json.dumps(clique) + "\n")
+            self._index = None
+
+    def delete_source(self, source: str, keep_hash: Optional[str] = None) -> None:
+        raise NotImplementedError("The numpy index is append-only, reload it from scratch to remove a source")
+
+    @property
+    def index(self) -> dict:
+        """Memory-map the vectors of the synonyms and centroids, and load the payloads and filtering arrays in memory."""
+        if self._index is None:
+            with open(self._file("meta.json")) as f:
+                vector_size = json.load(f)["vector_size"]
+            cliques = {}
+            if os.path.exists(self._file("cliques.jsonl")):
+                with open(self._file("cliques.jsonl")) as f:
+                    for line in f:
+                        clique = json.loads(line)
+                        cliques[clique["curie"]] = clique
+            self._index = {
+                "points": self._load_vectors("points", vector_size),
+                "centroids": self._load_vectors("centroids", vector_size),
+                "cliques": cliques,
+            }
+        return self._index
+
+    def _load_vectors(self, name: str, vector_size: int) -> dict:
+        vectors_file = self._file(f"{name}.f32")
+        if os.path.exists(vectors_file) and os.path.getsize(vectors_file) > 0:
+            vectors = np.memmap(vectors_file, dtype=np.float32, mode="r").reshape(-1, vector_size)
+        else:
+            vectors = np.zeros((0, vector_size), dtype=np.float32)
+        payloads = []
+        if os.path.exists(self._file(f"{name}.jsonl")):
+            with open(self._file(f"{name}.jsonl")) as f:
+                payloads = [json.loads(line) for line in f]
+        types_rows: Dict[str, List[int]] = {}
+        curie_rows: Dict[str, List[int]] = {}
+        for row, payload in enumerate(payloads):
+            for type_name in payload.get("types", []):
+                types_rows.setdefault(type_name, []).append(row)
+            curie_rows.setdefault(payload["curie"], []).append(row)
+        deleted = np.zeros(len(payloads), dtype=bool)
+        if name == "centroids":
+            # Only keep the last centroid appended for each CURIE
+            for rows in curie_rows.values():
+                deleted[rows[:-1]] = True
+        return {
+            "vectors": vectors,
+            "payloads": payloads,
+            "prefixes": np.array([payload.get("prefix", "") for payload in payloads], dtype=object),
+            "sources": np.array([payload.get("source", "") for payload in payloads], dtype=object),
+            "types": {type_name: np.array(rows) for type_name, rows in types_rows.items()},
+            "curies": {curie: np.array(rows) for curie, rows in curie_rows.items()},
+            "deleted": deleted if deleted.any() else None,
+        }
+
+    def _mask(self, points: dict, filters: Optional[SearchFilters]) -> Optional[np.ndarray]:
+        if (filters is None or not any(filters)) and points["deleted"] is None:
+            return None
+        mask = np.ones(len(points["payloads"]), dtype=bool) if points["deleted"] is None else ~points["deleted"]
+        if filters is None:
+            return mask
+        if filters.types:
+            type_mask = np.zeros(len(mask), dtype=bool)
+            for type_name in filters.types:
+                type_mask[points["types"].get(type_name, [])] = True
+            mask &= type_mask
+        if filters.prefixes:
+            mask &= np.isin(points["prefixes"], filters.prefixes)
+        if filters.exclude_prefixes:
+            mask &= ~np.isin(points["prefixes"], filters.exclude_prefixes)
+        if filters.sources:
+            mask &= np.isin(points["sources"], filters.sources)
+        return mask
+
+    def search_sync(
+        self, queries: List[VectorQuery], fetch_limits: List[int], name: str = "points"
+    ) -> List[List[Hit]]:
+        points = self.index[name]
+        vectors = points["vectors"]
+        query_vectors = np.array([query.vector for query in queries], dtype=np.float32)
+        query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        masks = [self._mask(points, query.filters) for query in queries]
+        best_rows = [np.zeros(0, dtype=np.int64) for _ in queries]
+        best_scores = [np.zeros(0, dtype=np.float32) for _ in queries]
+        # Queries restricted to a list of CURIEs only score the rows of these CURIEs
+        no_rows = np.zeros(0, dtype=np.int64)
+        candidates = {
+            i: np.concatenate([points["curies"].get(curie, no_rows) for curie in query.filters.curies])
+            for i, query in enumerate(queries)
+            if query.filters and query.filters.curies
+        }
+        for i, rows in candidates.items():
+            # Sorted rows are read in order from the memory-mapped file
+            rows = np.unique(rows)
+            if masks[i] is not None:
+                rows = rows[masks[i][rows]]
+            scores = vectors[rows] @ query_vectors[i]
+            keep = np.argsort(-scores, kind="stable")[: fetch_limits[i]]
+            best_rows[i], best_scores[i] = rows[keep], scores[keep]
+        full_scan = [i for i in range(len(queries)) if i not in candidates]
+        # Score all queries on a chunk of vectors at once, keeping the best rows of each query across chunks
+        for start in range(0, len(vectors) if full_scan else 0, self.chunk_size):
+            chunk_scores = vectors[start : start + self.chunk_size] @ query_vectors[full_scan].T
+            for j, i in enumerate(full_scan):
+                fetch_limit = fetch_limits[i]
+                scores = chunk_scores[:, j]
+                if masks[i] is not None:
+                    scores = np.where(masks[i][start : start + len(scores)], scores, -np.inf)
+                k = min(fetch_limit, len(scores))
+                top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+                rows = np.concatenate([best_rows[i], top + start])
+                row_scores = np.concatenate([best_scores[i], scores[top]])
+                keep = np.argsort(-row_scores, kind="stable")[:fetch_limit]
+                best_rows[i], best_scores[i] = rows[keep], row_scores[keep]
+        results = []
+        for rows, scores in zip(best_rows, best_scores):
+            hits = []
+            for row, score in zip(rows, scores):
+                if score == -np.inf:
+                    break
+                payload = points["payloads"][row]
+                hits.append(Hit(payload["curie"], payload.get("embedded_label", ""), float(score), payload))
+            results.append(hits)
+        return results
+
+    async def search_hits(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.search_sync, queries, fetch_limits)
+
+    async def search_centroids(self, queries: List[VectorQuery], fetch_limits: List[int]) -> List[List[Hit]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.search_sync, queries, fetch_limits, "centroids"
+        )
+
+    async def get_cliques(self, curies: List[str], fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        cliques = self.index["cliques"]
+        return {curie: project(cliques[curie], fields) for curie in curies if curie in cliques}
+
+
+def backend_from_env() -> VectorBackend:
+    """Build the backend from the `VECTOR_BACKEND` env variable: `qdrant` (default), `pgvector` or `numpy`."""
+    backend = os.getenv("VECTOR_BACKEND", "qdrant")
+    if backend == "qdrant":
+        return QdrantBackend(
+            host=os.getenv("QDRANT_HOST", "qdrant"), named_vectors=bool(os.getenv("RERANK_EMBEDDING_MODEL"))
+        )
+    if backend == "pgvector":
+        return PgvectorBackend(
+            conninfo=os.getenv("PG_CONNECT", PG_CONNECT),
+            table=os.getenv("PG_TABLE", "concept_resolver_embeddings"),
+            index=os.getenv("PG_INDEX", "hnsw"),
+            ef_search=int(os.environ["PG_HNSW_EF_SEARCH"]) if os.getenv("PG_HNSW_EF_SEARCH") else None,
+            probes=int(os.environ["PG_IVFFLAT_PROBES"]) if os.getenv("PG_IVFFLAT_PROBES") else None,
+            iterative_scan=os.getenv("PG_ITERATIVE_SCAN"),
+        )
+    if backend == "numpy":
+        return NumpyBackend(path=os.getenv("NUMPY_INDEX_PATH", "data/index"))
+    raise ValueError(f"Unknown vector backend {backend}, use qdrant, pgvector or numpy")
+
+
+def add_backend_arguments(parser) -> None:
+    """Add the options to choose the backend to the argparse parser of a loader."""
+    parser.add_argument("--backend", choices=["qdrant", "pgvector", "numpy"], default="qdrant", help="Vector store")
+    parser.add_argument("--qdrant-host", default="qdrant", help="Host of the Qdrant vectordb")
+    parser.add_argument("--pg-connect", default=PG_CONNECT, help="Connection string of the pgvector database")
+    parser.add_argument("--pg-table", default="concept_resolver_embeddings", help="Table of the pgvector embeddings")
+    parser.add_argument(
+        "--pg-index", choices=["hnsw", "ivfflat"], default="hnsw", help="ANN index built on the pgvector embeddings"
+    )
+    parser.add_argument("--index-path", default="data/index", help="Directory of the numpy index")
+
+
+def backend_from_args(args) -> VectorBackend:
+    if args.backend == "pgvector":
+        return PgvectorBackend(conninfo=args.pg_connect, table=args.pg_table, index=args.pg_index)
+    if args.backend == "numpy":
+        return NumpyBackend(path=args.index_path)
+    return QdrantBackend(host=args.qdrant_host, named_vectors=bool(os.getenv("RERANK_EMBEDDING_MODEL")))
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from src.metrics import EMBEDDING_BATCH_SIZE, STAGE_SECONDS
+
+
+class EmbeddingBatcher:
+    """Coalesce the strings submitted by concurrent requests into one call to the embedding model.
+
+    A batch is sent to the executor when `max_batch_size` strings are pending, or `max_wait` seconds
+    after the first string of the batch was submitted, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[np.ndarray]],
+        executor: Executor,
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+    ):
+        self.embed_fn = embed_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._pending_count = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, strings: List[str]) -> List[np.ndarray]:
+        """Embed the strings, together with the ones submitted concurrently by other requests."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((strings, future))
+        self._pending_count += len(strings)
+        if self._pending_count >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = []
+        self._pending_count = 0
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        # Keep a reference to the task so it is not garbage collected before completion
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        strings = [string for request_strings, _ in batch for string in request_strings]
+        EMBEDDING_BATCH_SIZE.observe(len(strings))
+        start = time.perf_counter()
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: list(self.embed_fn(strings))
+            )
+            # The batch is shared by multiple requests, so it is not reported in the Server-Timing of one of them
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="embedding_model")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for request_strings, future in batch:
+            if not future.done():
+                future.set_result(vectors[start : start + len(request_strings)])
+            start += len(request_strings)
@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src import api, babel_load
+from src.backends import NumpyBackend, QdrantBackend, VectorBackend, add_backend_arguments, backend_from_args
+
+# Gold standard TSV: one mention per line with the expected CURIE, multiple accepted CURIEs are separated by |
+# mention	curie
+# alzheimer	MONDO:0004975
+
+
+def load_gold(gold_file: str) -> List[Tuple[str, List[str]]]:
+    with open(gold_file, newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        return [(row["mention"], row["curie"].split("|")) for row in reader if row.get("mention")]
+
+
+def load_memory_index(backend_name: str, synonym_dir: str, workers: int, batch_size: int) -> VectorBackend:
+    """Load synonyms files in a local index stored in a temporary folder, so the benchmark runs without a server."""
+    path = tempfile.mkdtemp(prefix="concept-resolver-benchmark-")
+    backend = NumpyBackend(path) if backend_name == "numpy" else QdrantBackend(path=path)
+    backend.create(babel_load.flag_embeddings_size, rerank_vector_size=babel_load.RERANK_EMBEDDING_SIZE)
+    babel_load.load_synonyms(
+        backend,
+        synonym_dir=synonym_dir,
+        manifest=babel_load.Manifest(os.path.join(path, "manifest.json")),
+        workers=workers,
+        batch_size=batch_size,
+        upload_parallel=1,
+    )
+    backend.publish()
+    # The local Qdrant can only be opened by one client, close the one used for loading before searching
+    backend.close()
+    return backend
+
+
+async def resolve(
+    mention: str, limit: int, two_stage: bool = False, rerank_candidates: Optional[int] = None
+) -> Tuple[List[str], float, float]:
+    """Run a mention through lookup(), returns the CURIEs found and the time spent embedding and searching."""
+    start = time.perf_counter()
+    await api.embed_strings([mention])
+    embed_time = time.perf_counter() - start
+    # The embedding is now in cache, so lookup() only pays for the search and hydration of the results
+    start = time.perf_counter()
+    results = await api.lookup(
+        mention,
+        autocomplete=False,
+        limit=limit,
+        two_stage=two_stage,
+        rerank=rerank_candidates is not None,
+        rerank_candidates=rerank_candidates or api.rerank_candidates_default,
+    )
+    search_time = time.perf_counter() - start
+    return [result["curie"] for result in results], embed_time, search_time
+
+
+async def run_benchmark(
+    gold: List[Tuple[str, List[str]]],
+    limit: int,
+    concurrency: int,
+    two_stage: bool = False,
+    rerank_candidates: Optional[int] = None,
+) -> Dict:
+    api.embedding_cache.clear()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(mention: str) -> Tuple[List[str], float, float]:
+        async with semaphore:
+            return await resolve(mention, limit, two_stage, rerank_candidates)
+
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*(run_one(mention) for mention, _ in gold))
+    total_time = time.perf_counter() - start
+
+    ks = [k for k in [1, 5, 10] if k <= limit]
+    hits_at = {k: 0 for k in ks}
+    reciprocal_ranks = []
+    failures = []
+    for (mention, expected), (curies, _, _) in zip(gold, outputs):
+        rank: Optional[int] = next((i + 1 for i, curie in enumerate(curies) if curie in expected), None)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        for k in ks:
+            if rank and rank <= k:
+                hits_at[k] += 1
+        if rank != 1:
+            failures.append({"mention": mention, "expected": expected, "rank": rank, "top": curies[:3]})
+
+    embed_times = np.array([output[1] for output in outputs]) * 1000
+    search_times = np.array([output[2] for output in outputs]) * 1000
+
+    def percentiles(times: np.ndarray) -> Dict[str, float]:
+        return {f"p{p}": round(float(np.percentile(times, p)), 3) for p in [50, 95, 99]}
+
+    return {
+        "queries": len(gold),
+        **{f"recall@{k}": hits_at[k] / len(gold) for k in ks},
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "throughput_qps": len(gold) / total_time,
+        "latency_ms": {
+            "embed": percentiles(embed_times),
+            "search": percentiles(search_times),
+            "total": percentiles(embed_times + search_times),
+        },
+        "failures": failures,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the recall and latency of the concept resolution")
+    parser.add_argument("gold", help="TSV file with a mention and curie column")
+    add_backend_arguments(parser)
+    parser.add_argument(
+        "--memory",
+        metavar="SYNONYM_DIR",
+        help="Load the synonyms files of this directory in a local Qdrant (or numpy index) instead of using a server",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes used to load --memory")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Batch size used to load --memory")
+    parser.add_argument("--limit", type=int, default=10, help="Number of results retrieved for each mention")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of mentions resolved concurrently")
+    parser.add_argument(
+        "--two-stage", action="store_true", help="Search the concepts centroids first, then rescore their synonyms"
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        metavar="CANDIDATES",
+        help="Rerank this number of candidates with the vectors of RERANK_EMBEDDING_MODEL",
+    )
+    parser.add_argument("--name", default="", help="Name of the run, to identify it when comparing results")
+    parser.add_argument("--output", default="data/benchmark", help="Directory where the results are written")
+    args = parser.parse_args()
+
+    gold = load_gold(args.gold)
+    if args.memory:
+        api.backend = load_memory_index(args.backend, args.memory, args.workers, args.batch_size)
+        backend = f"local {args.backend}:{args.memory}"
+    else:
+        api.backend = backend_from_args(args)
+        backend = args.backend
+
+    results = {
+        "name": args.name,
+        "date": datetime.now().isoformat(),
+        "gold": args.gold,
+        "backend": backend,
+        "limit": args.limit,
+        "concurrency": args.concurrency,
+        "two_stage": args.two_stage,
+        "rerank": args.rerank,
+        **asyncio.run(run_benchmark(gold, args.limit, args.concurrency, args.two_stage, args.rerank)),
+    }
+
+    print(f"Resolved {results['queries']} mentions from {args.gold} with {backend}")
+    for key in ["recall@1", "recall@5", "recall@10", "mrr", "throughput_qps"]:
+        if key in results:
+            print(f"  {key}: {results[key]:.3f}")
+    for stage, values in results["latency_ms"].items():
+        print(f"  {stage} latency (ms): {values}")
+
+    os.makedirs(args.output, exist_ok=True)
+    output_file = os.path.join(
+        args.output, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}{'-' + args.name if args.name else ''}.json"
+    )
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class CentroidAccumulator:
+    """Streaming mean of the synonyms vectors of each CURIE, only the running sum and count are kept in memory.
+
+    The synonyms of a CURIE can be added across multiple batches, `flush()` returns the centroids accumulated so far.
+    """
+
+    def __init__(self):
+        self.sums: Dict[str, np.ndarray] = {}
+        self.counts: Dict[str, int] = {}
+        self.payloads: Dict[str, dict] = {}
+
+    def add(self, curies: List[str], vectors: np.ndarray, payloads: Optional[List[dict]] = None) -> None:
+        """Add the vectors of a batch, the payload of a CURIE is the one of its first vector."""
+        if not curies:
+            return
+        # Sum the vectors of each CURIE of the batch at once, then merge them in the running sums
+        batch_curies, first_rows, inverse = np.unique(
+            np.array(curies, dtype=object), return_index=True, return_inverse=True
+        )
+        vectors = np.asarray(vectors, dtype=np.float32)
+        sums = np.zeros((len(batch_curies), vectors.shape[1]), dtype=np.float32)
+        np.add.at(sums, inverse, vectors)
+        counts = np.bincount(inverse, minlength=len(batch_curies))
+        for curie, first_row, vector_sum, count in zip(batch_curies, first_rows, sums, counts):
+            if curie in self.sums:
+                self.sums[curie] += vector_sum
+                self.counts[curie] += int(count)
+            else:
+                self.sums[curie] = vector_sum
+                self.counts[curie] = int(count)
+                self.payloads[curie] = dict(payloads[first_row]) if payloads else {"curie": curie}
+
+    def flush(self) -> Tuple[List[str], np.ndarray, List[dict]]:
+        """Return the normalized centroids with their payloads (including the number of synonyms), and reset."""
+        curies = list(self.sums)
+        if not curies:
+            return [], np.zeros((0, 0), dtype=np.float32), []
+        vectors = np.stack([self.sums[curie] for curie in curies])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        payloads = [{**self.payloads[curie], "count": self.counts[curie]} for curie in curies]
+        self.sums, self.counts, self.payloads = {}, {}, {}
+        return curies, vectors, payloads
+
+    def __len__(self) -> int:
+        return len(self.sums)
@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_string(string: str) -> str:
+    """Fold case and collapse whitespace, the bge tokenizer is uncased so this does not change the embedding."""
+    return " ".join(string.split()).casefold()
+
+
+class RedisEmbeddingStore:
+    """Shared embedding store, so that multiple workers (or pods) reuse each other's embeddings."""
+
+    def __init__(self, url: str, prefix: str = "concept-resolver:embedding:", ttl: Optional[int] = None):
+        # Only imported when a shared store is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32)
+
+    def set(self, key: str, vector: np.ndarray) -> None:
+        self.client.set(self.prefix + key, np.asarray(vector, dtype=np.float32).tobytes(), ex=self.ttl)
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of embeddings keyed by the normalized string."""
+
+    def __init__(self, max_size: int = 10000, store: Optional[RedisEmbeddingStore] = None):
+        self.max_size = max_size
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                return vector
+        if self.store is not None:
+            try:
+                vector = self.store.get(key)
+            except Exception as e:
+                print(f"Error reading embedding from the shared store: {e}")
+                vector = None
+            if vector is not None:
+                self._put(key, vector)
+        return vector
+
+    def set(self, key: str, vector: np.ndarray) -> None:
+        self._put(key, vector)
+        if self.store is not None:
+            try:
+                self.store.set(key, vector)
+            except Exception as e:
+                print(f"Error writing embedding to the shared store: {e}")
+
+    def _put(self, key: str, vector: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def embed(self, strings: List[str], embed_fn: Callable[[List[str]], List[np.ndarray]]) -> List[np.ndarray]:
+        """Return one embedding per string, only calling `embed_fn` for the normalized strings not in cache."""
+        vectors, missing = self.lookup(strings)
+        if missing:
+            self.fill(vectors, missing, embed_fn(list(missing)))
+        return vectors
+
+    async def aembed(
+        self, strings: List[str], embed_fn: Callable[[List[str]], Awaitable[List[np.ndarray]]]
+    ) -> List[np.ndarray]:
+        """Same as `embed()`, with an async `embed_fn`."""
+        vectors, missing = self.lookup(strings)
+        if missing:
+            self.fill(vectors, missing, await embed_fn(list(missing)))
+        return vectors
+
+    def lookup(self, strings: List[str]) -> Tuple[List[Optional[np.ndarray]], Dict[str, List[int]]]:
+        """Get the cached vectors, and the positions of each normalized string missing from the cache."""
+        keys = [normalize_string(string) for string in strings]
+        vectors: List[Optional[np.ndarray]] = [None] * len(keys)
+        missing: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            if key in missing:
+                missing[key].append(i)
+                continue
+            vector = self.get(key)
+            if vector is None:
+                missing[key] = [i]
+            else:
+                vectors[i] = vector
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return vectors, missing
+
+    def fill(
+        self, vectors: List[Optional[np.ndarray]], missing: Dict[str, List[int]], new_vectors: List[np.ndarray]
+    ) -> None:
+        """Cache the vectors embedded for the `missing` strings of `lookup()`, and set them at their positions."""
+        for key, vector in zip(missing, new_vectors):
+            self.set(key, vector)
+            for i in missing[key]:
+                vectors[i] = vector
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._cache), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+def cache_from_env(model_name: str) -> EmbeddingCache:
+    """Build the query embedding cache from the `EMBEDDING_CACHE_SIZE` and `EMBEDDING_CACHE_REDIS_URL` env variables.
+
+    The keys of the shared store are prefixed with the model, so workers running different models (or different
+    variants of a model) never read each other's vectors.
+    """
+    redis_url = os.getenv("EMBEDDING_CACHE_REDIS_URL")
+    return EmbeddingCache(
+        max_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        store=RedisEmbeddingStore(redis_url, prefix=f"concept-resolver:embedding:{model_name}:") if redis_url else None,
+    )
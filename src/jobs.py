@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+
+from src.embedding_cache import normalize_string
+
+# Resolve a batch of distinct strings with the parameters of the job, returns the results of each string
+ResolveFn = Callable[[List[str], dict], Awaitable[List[List[dict]]]]
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+def read_labels(
+    path: str, file_format: str, batch_size: int, header: bool = False
+) -> Iterator[List[Tuple[int, str]]]:
+    """Read batches of (line number, label) from a file with one label per line.
+
+    The label is the first column of TSV files, and the `string` (or `label`) of the objects of JSONL files,
+    or the line itself when it is a JSON string.
+    """
+    batch: List[Tuple[int, str]] = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line_number, line in enumerate(f):
+            line = line.rstrip("\r\n")
+            if header and line_number == 0:
+                continue
+            if file_format == "jsonl":
+                if not line.strip():
+                    continue
+                try:
+                    value = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"Line {line_number + 1} is not valid JSON: {e}") from e
+                label = value if isinstance(value, str) else str(value.get("string") or value.get("label") or "")
+            else:
+                label = line.split("\t", 1)[0]
+            batch.append((line_number, label))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class JobStore:
+    """Bulk resolution jobs of label files, resolved in batches by background workers of the API.
+
+    Each job has a directory with its uploaded file, its status, the NDJSON results written as the batches
+    are resolved, and a SQLite table of the labels already resolved, so labels repeated in the file are only
+    resolved once while memory stays bounded by the size of a batch. Status and results are read from the files,
+    so any worker of the API can report the progress and stream the results of a job.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        resolve: ResolveFn,
+        batch_size: int = 256,
+        concurrency: int = 1,
+        poll_interval: float = 0.2,
+    ):
+        self.path = path
+        self.resolve = resolve
+        # SQLite limits the number of parameters of a query, which is the number of distinct labels of a batch
+        self.batch_size = min(batch_size, 900)
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def _file(self, job_id: str, name: str) -> str:
+        return os.path.join(self.path, job_id, name)
+
+    def start(self) -> None:
+        """Start the workers, in the event loop of the API."""
+        self.queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def get(self, job_id: str) -> Optional[dict]:
+        # Job IDs are hex UUIDs, anything else is not a directory of the store
+        if not job_id.isalnum() or not os.path.exists(self._file(job_id, "status.json")):
+            return None
+        with open(self._file(job_id, "status.json")) as f:
+            return json.load(f)
+
+    def _save(self, status: dict) -> None:
+        tmp_path = self._file(status["id"], "status.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self._file(status["id"], "status.json"))
+
+    async def create(self, chunks: AsyncIterator[bytes], file_format: str, params: dict, header: bool = False) -> dict:
+        """Write the uploaded file to the job directory as it is received, and queue the job."""
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(os.makedirs, os.path.join(self.path, job_id))
+        lines = 0
+        last_chunk = b""
+        with await asyncio.to_thread(open, self._file(job_id, "input"), "wb") as f:
+            async for chunk in chunks:
+                await asyncio.to_thread(f.write, chunk)
+                lines += chunk.count(b"\n")
+                last_chunk = chunk or last_chunk
+        if last_chunk and not last_chunk.endswith(b"\n"):
+            lines += 1
+        status = {
+            "id": job_id,
+            "status": "queued",
+            "format": file_format,
+            "header": header,
+            "params": params,
+            "lines_total": lines - 1 if header and lines else lines,
+            "lines_done": 0,
+            "labels_resolved": 0,
+            "labels_reused": 0,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        await asyncio.to_thread(self._save, status)
+        await self.queue.put(job_id)
+        return status
+
+    def cancel(self, job_id: str) -> None:
+        """Delete a finished job, or ask the worker running it to stop and delete it."""
+        status = self.get(job_id)
+        if status is None:
+            return
+        if status["status"] in FINISHED_STATUSES:
+            shutil.rmtree(os.path.join(self.path, job_id), ignore_errors=True)
+            return
+        # The job can be run by the worker of another process, which checks this file between batches
+        open(self._file(job_id, "cancel"), "w").close()
+
+    async def _work(self) -> None:
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            except Exception as e:
+                print(f"Error running job {job_id}: {e}")
+                status = await asyncio.to_thread(self.get, job_id)
+                if status is not None:
+                    status.update({"status": "failed", "error": str(e), "finished_at": time.time()})
+                    await asyncio.to_thread(self._save, status)
+
+    async def run(self, job_id: str) -> None:
+        # Only the resolution runs in the event loop, the reads and writes of the job files and of its SQLite
+        # table run in threads so they do not block the lookups served meanwhile
+        status = await asyncio.to_thread(self.get, job_id)
+        status.update({"status": "running", "started_at": time.time()})
+        await asyncio.to_thread(self._save, status)
+        # The connection is used by one thread at a time, but not always the same one
+        db = await asyncio.to_thread(sqlite3.connect, self._file(job_id, "labels.sqlite"), check_same_thread=False)
+        try:
+            await asyncio.to_thread(
+                db.execute, "CREATE TABLE IF NOT EXISTS results (label TEXT PRIMARY KEY, results BLOB)"
+            )
+            batches = read_labels(self._file(job_id, "input"), status["format"], self.batch_size, status["header"])
+            with open(self._file(job_id, "results.ndjson"), "wb") as out:
+                while True:
+                    batch = await asyncio.to_thread(next, batches, None)
+                    if batch is None:
+                        status["status"] = "done"
+                        break
+                    if await asyncio.to_thread(os.path.exists, self._file(job_id, "cancel")):
+                        status["status"] = "cancelled"
+                        break
+                    keys = [normalize_string(label) for _, label in batch]
+                    known = await asyncio.to_thread(self._known_results, db, keys)
+                    missing = [key for key in dict.fromkeys(keys) if key not in known]
+                    resolved = {}
+                    if missing:
+                        resolved = {
+                            key: orjson.dumps(results)
+                            for key, results in zip(missing, await self.resolve(missing, status["params"]))
+                        }
+                        known.update(resolved)
+                    await asyncio.to_thread(self._write_batch, db, out, status, batch, keys, known, resolved)
+        finally:
+            await asyncio.to_thread(db.close)
+        status["finished_at"] = time.time()
+        if status["status"] == "cancelled":
+            await asyncio.to_thread(shutil.rmtree, os.path.join(self.path, job_id), ignore_errors=True)
+            return
+        await asyncio.to_thread(self._save, status)
+        # The labels table is only needed while the job runs
+        await asyncio.to_thread(os.remove, self._file(job_id, "labels.sqlite"))
+
+    @staticmethod
+    def _known_results(db: sqlite3.Connection, keys: List[str]) -> Dict[str, bytes]:
+        """Results of the labels of a batch already resolved, and of the empty label."""
+        distinct = [key for key in dict.fromkeys(keys) if key]
+        known = {"": b"[]"}
+        known.update(
+            db.execute(
+                f"SELECT label, results FROM results WHERE label IN ({', '.join('?' * len(distinct))})", distinct
+            ).fetchall()
+        )
+        return known
+
+    def _write_batch(
+        self,
+        db: sqlite3.Connection,
+        out: BinaryIO,
+        status: dict,
+        batch: List[Tuple[int, str]],
+        keys: List[str],
+        known: Dict[str, bytes],
+        resolved: Dict[str, bytes],
+    ) -> None:
+        if resolved:
+            db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?)", resolved.items())
+            db.commit()
+        # Results are only written by complete lines, so they can be streamed while the job runs
+        out.write(
+            b"".join(
+                b'{"line":%d,"string":%s,"results":%s}\n' % (line_number + 1, orjson.dumps(label), known[key])
+                for (line_number, label), key in zip(batch, keys)
+            )
+        )
+        out.flush()
+        status["lines_done"] += len(batch)
+        status["labels_resolved"] += len(resolved)
+        status["labels_reused"] += sum(1 for key in keys if key) - len(resolved)
+        self._save(status)
+
+    async def stream_results(self, job_id: str) -> AsyncIterator[bytes]:
+        """Stream the NDJSON results of a job, waiting for the next batches until the job is finished."""
+        results_file = self._file(job_id, "results.ndjson")
+        while not await asyncio.to_thread(os.path.exists, results_file):
+            status = await asyncio.to_thread(self.get, job_id)
+            if status is None or status["status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(self.poll_interval)
+        with await asyncio.to_thread(open, results_file, "rb") as f:
+            # Start of a line not completely read yet, lines can be longer than a chunk
+            partial = b""
+            while True:
+                # Check the status before reading, so the lines written before the job finished are all read
+                status = await asyncio.to_thread(self.get, job_id)
+                finished = status is None or status["status"] in FINISHED_STATUSES
+                chunk = await asyncio.to_thread(f.read, 1024 * 1024)
+                end = chunk.rfind(b"\n") + 1
+                if end:
+                    # Only send complete lines
+                    yield partial + chunk[:end]
+                    partial = chunk[end:]
+                elif chunk:
+                    partial += chunk
+                elif finished:
+                    return
+                else:
+                    await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,250 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets of the histograms of sizes (strings per batch, results per query...)
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """Metric of the Prometheus text format, with one value per combination of the values of its labels.
+
+    Values are kept in the process, each worker of the API exposes its own metrics.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional[list] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Get the value from a function when the metrics are collected, for values already tracked elsewhere."""
+        self._function = function
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yield the (name, labels, value) of each sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {value:g}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        if self._function is not None:
+            yield self.name, "", self._function()
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # Count of the observations in each bucket (the last one is +Inf), and sum of the observations
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[bucket] += 1
+            self._sums[key] += value
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket", _format_labels(self.labelnames + ("le",), key + (le,)), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics(registry: Optional[List[Metric]] = None) -> str:
+    """All the metrics of the registry in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in (REGISTRY if registry is None else registry)) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "concept_resolver_stage_seconds", "Time spent in each stage of the requests or of the ingestion", ["stage"]
+)
+STAGE_ITEMS = Counter(
+    "concept_resolver_stage_items_total", "Number of strings or labels processed by each stage", ["stage"]
+)
+REQUESTS = Counter("concept_resolver_requests_total", "Number of HTTP requests", ["endpoint", "method", "status"])
+REQUEST_SECONDS = Histogram("concept_resolver_request_seconds", "Duration of the HTTP requests", ["endpoint"])
+QUERIES_PER_REQUEST = Histogram(
+    "concept_resolver_queries_per_request", "Number of strings looked up per request", ["endpoint"], buckets=SIZE_BUCKETS
+)
+RESULTS_PER_QUERY = Histogram(
+    "concept_resolver_results_per_query", "Number of results returned per string", ["endpoint"], buckets=SIZE_BUCKETS
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "concept_resolver_embedding_batch_size", "Number of strings embedded per call to the model", buckets=SIZE_BUCKETS
+)
+EMBEDDING_CACHE_HITS = Counter("concept_resolver_embedding_cache_hits_total", "Strings found in the embedding cache")
+EMBEDDING_CACHE_MISSES = Counter(
+    "concept_resolver_embedding_cache_misses_total", "Strings missing from the embedding cache"
+)
+INGEST_LABELS = Counter(
+    "concept_resolver_ingest_labels_total",
+    "Labels read by the loaders, by outcome: collapsed with an equivalent label of their clique, "
+    "embedding reused from a previous label, or embedded",
+    ["outcome"],
+)
+
+# Time spent in each stage by the current request, reported in its Server-Timing header
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def record(stage: str, seconds: float, items: Optional[int] = None) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if items is not None:
+        STAGE_ITEMS.inc(items, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str, items: Optional[int] = None) -> Iterator[None]:
+    """Record the time spent in the block as a stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, items)
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """Value of the Server-Timing header, durations are in milliseconds."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in [*timings.items(), ("total", total)])
+
+
+class MetricsMiddleware:
+    """Count the requests and their duration per route, and add the time of their stages in a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings: Dict[str, float] = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings, time.perf_counter() - start).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            # Label by route template rather than path, so the number of series stays bounded
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUESTS.inc(endpoint=endpoint, method=scope["method"], status=str(status))
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+
+
+class StageTimer:
+    """Accumulate the number of labels processed and the time spent by one stage of an ingestion pipeline."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.labels = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, labels: int, seconds: float) -> None:
+        with self._lock:
+            self.labels += labels
+            self.seconds += seconds
+        record(f"ingest_{self.name.lower()}", seconds, labels)
+
+    def rate(self) -> float:
+        return self.labels / self.seconds if self.seconds else 0
+
+    def report(self, parallelism: int = 1) -> str:
+        rate = self.rate()
+        return f"{self.name}: {self.labels} labels in {self.seconds:.1f}s of work, {rate:.0f} labels/s per worker, ~{rate * parallelism:.0f} labels/s with {parallelism} workers"
+
+
+def write_metrics(path: str) -> None:
+    """Write the metrics to a file, e.g. for the textfile collector of the Prometheus node exporter."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render_metrics())
+    os.replace(tmp_path, path)
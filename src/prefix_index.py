@@ -0,0 +1,144 @@
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.backends import Hit, SearchFilters
+from src.embedding_cache import normalize_string
+
+
+class PrefixIndex:
+    """Sorted array of the normalized labels with the CURIE of each label, to complete prefixes without embedding.
+
+    Labels are stored as one UTF-8 blob with the offset of each label, sorted so that all the labels starting
+    with a prefix are contiguous and found with a binary search. Arrays are memory-mapped, so the workers of
+    the API share them through the OS page cache.
+    """
+
+    # Maximum number of labels starting with the prefix that are ranked, in lexicographic order
+    max_candidates = int(os.getenv("AUTOCOMPLETE_MAX_CANDIDATES", "256"))
+
+    def __init__(self, path: str):
+        self.path = path
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+        self.label_offsets = np.load(os.path.join(path, "label_offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode="r")
+        self.preferred = np.load(os.path.join(path, "preferred.npy"), mmap_mode="r")
+        self.curies = np.load(os.path.join(path, "curies.npy"), mmap_mode="r")
+        self.curie_offsets = np.load(os.path.join(path, "curie_offsets.npy"), mmap_mode="r")
+
+    @classmethod
+    def open(cls, path: str) -> Optional["PrefixIndex"]:
+        """Open the index if it has been built."""
+        if not os.path.exists(os.path.join(path, "labels.npy")):
+            return None
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.label_offsets) - 1
+
+    def _label(self, row: int) -> bytes:
+        return self.labels[int(self.label_offsets[row]) : int(self.label_offsets[row + 1])].tobytes()
+
+    def _curie(self, curie_id: int) -> Tuple[str, List[str]]:
+        start, end = self.curie_offsets[curie_id : curie_id + 2]
+        curie, types = self.curies[int(start) : int(end)].tobytes().decode().split("\t")
+        return curie, types.split("|") if types else []
+
+    def _lower_bound(self, key: bytes) -> int:
+        """Row of the first label greater or equal to the key."""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._label(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def search(self, prefix: str, limit: int = 10, filters: Optional[SearchFilters] = None) -> List[Hit]:
+        """Get the best `limit` CURIEs with a label starting with the prefix.
+
+        The score is the fraction of the label covered by the prefix, so exact matches score 1,
+        and preferred labels are ranked first between labels with the same score.
+        """
+        key = normalize_string(prefix).encode()
+        if not key or limit <= 0:
+            return []
+        # Read the labels following the prefix position at once, and keep the ones starting with the prefix
+        start = self._lower_bound(key)
+        end = min(start + self.max_candidates, len(self))
+        offsets = self.label_offsets[start : end + 1].tolist()
+        preferred = self.preferred[start:end].tolist()
+        blob = self.labels[offsets[0] : offsets[-1]].tobytes() if offsets else b""
+        candidates = []
+        for i in range(end - start):
+            label = blob[offsets[i] - offsets[0] : offsets[i + 1] - offsets[0]]
+            if not label.startswith(key):
+                break
+            candidates.append((-len(key) / len(label), not preferred[i], start + i, label))
+        candidates.sort()
+        # Only decode the CURIEs of the best candidates, until there are enough distinct ones matching the filters
+        hits: Dict[str, Hit] = {}
+        for negative_score, _, row, label in candidates:
+            curie, types = self._curie(int(self.postings[row]))
+            if curie in hits or (filters is not None and not matches_filters(curie, types, filters)):
+                continue
+            payload = {"curie": curie, "prefix": curie.split(":")[0], "types": types}
+            hits[curie] = Hit(curie, label.decode(), -negative_score, payload)
+            if len(hits) >= limit:
+                break
+        return list(hits.values())
+
+    @staticmethod
+    def build(entries: Iterable[Tuple[str, str, List[str], bool]], path: str) -> int:
+        """Build the index from (label, curie, types, is_preferred_label) entries, returns the number of labels.
+
+        The index is written in a temporary directory and then moved to `path`.
+        """
+        curie_ids: Dict[str, int] = {}
+        curie_docs: List[bytes] = []
+        rows: Dict[Tuple[bytes, int], bool] = {}
+        for label, curie, types, preferred in entries:
+            key = normalize_string(label).encode()
+            if not key:
+                continue
+            curie_id = curie_ids.get(curie)
+            if curie_id is None:
+                curie_id = curie_ids[curie] = len(curie_docs)
+                curie_docs.append(f"{curie}\t{'|'.join(types)}".encode())
+            rows[(key, curie_id)] = rows.get((key, curie_id), False) or preferred
+        # UTF-8 bytes sort in the same order as the code points of the strings
+        keys = sorted(rows)
+
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        def save_blob(name: str, values: List[bytes]) -> None:
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            np.save(os.path.join(tmp_path, f"{name}s.npy"), np.frombuffer(b"".join(values), dtype=np.uint8))
+            np.save(os.path.join(tmp_path, f"{name}_offsets.npy"), offsets)
+
+        save_blob("label", [key for key, _ in keys])
+        save_blob("curie", curie_docs)
+        np.save(os.path.join(tmp_path, "postings.npy"), np.array([curie_id for _, curie_id in keys], dtype=np.int32))
+        np.save(os.path.join(tmp_path, "preferred.npy"), np.array([rows[key] for key in keys], dtype=np.uint8))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return len(keys)
+
+
+def matches_filters(curie: str, types: List[str], filters: SearchFilters) -> bool:
+    prefix = curie.split(":")[0]
+    if filters.types and not set(filters.types) & set(types):
+        return False
+    if filters.prefixes and prefix not in filters.prefixes:
+        return False
+    if filters.exclude_prefixes and prefix in filters.exclude_prefixes:
+        return False
+    if filters.curies and curie not in filters.curies:
+        return False
+    return True
@@ -1,26 +1,39 @@
+import json
 import os
-from typing import Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator
 import pandas as pd
 import numpy as np
 import zipfile
 from io import BytesIO
-import psycopg
-from pgvector.psycopg import register_vector
 from tqdm import tqdm
-from fastembed.embedding import FlagEmbedding
 import requests
 from bs4 import BeautifulSoup
 
+from src.backends import PgvectorBackend, point_id
+from src.centroids import CentroidAccumulator
+from src.embeddings import GenEmbeddings
+from src.metrics import StageTimer
+
 bad_zipfiles = []
 error_gen_embeddings = []
 pg_connect = "dbname=postgres user=postgres password=password host=db"
 
+# Base URL of PubDictionaries, can be changed to download from a mirror or a local server
+pubdict_url = os.getenv("PUBDICT_URL", "https://pubdictionaries.org").rstrip("/")
+download_timeout = 300
+
 # Get all dicts
-dicts_url = "https://pubdictionaries.org/dictionaries?grid%5Border%5D=created_at&grid%5Border_direction%5D=desc&grid%5Bpp%5D=187"
+dicts_url = f"{pubdict_url}/dictionaries?grid%5Border%5D=created_at&grid%5Border_direction%5D=desc&grid%5Bpp%5D=187"
 
 chunk_size = 100000
 points_count = 0
 
+# Labels and time spent embedding and upserting, over all the dictionaries
+embed_timer = StageTimer("Embed")
+upsert_timer = StageTimer("Upsert")
+
 
 def extract_pubdictionaries(url):
     resp = requests.get(url)
@@ -39,74 +52,141 @@ def extract_pubdictionaries(url):
     return dictionary_names
 
 
-class GenEmbeddings:
-    def __init__(self):
-        """Initialize the Embedding object with a model and embedding size."""
-        self.embedding_model = FlagEmbedding(
-            model_name="BAAI/bge-small-en-v1.5", max_length=512
-        )
-        self.embedding_size = 384
-        # self.embedding_model = FlagEmbedding(model_name="BAAI/bge-base-en-v1.5", max_length=512)
-        # self.embedding_size = 768
-
-    def embed(self, labels: list[str]):
-        """
-        Generate embeddings for the given input data using the specified model.
-        This is a placeholder function and should be implemented according to the specific model's requirements.
-
-        :param labels: The data for which embeddings are to be generated.
-        :return: Embeddings for the input data.
-        """
-        return [embedding.tolist() for embedding in self.embedding_model.embed(labels)]
+embed_model = GenEmbeddings()
 
 
-embed_model = GenEmbeddings()
+def fetch(url: str, filename: str) -> bool:
+    """Stream the URL to the file in chunks, returns False if the file was not modified since the last download.
+
+    The ETag and Last-Modified headers of the response are stored next to the file, and sent back to the server
+    on the next download so it can answer 304 Not Modified.
+    """
+    validators_file = f"{filename}.headers.json"
+    headers = {}
+    if os.path.exists(filename) and os.path.exists(validators_file):
+        with open(validators_file) as f:
+            validators = json.load(f)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    with requests.get(url, headers=headers, stream=True, timeout=download_timeout) as response:
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        # Write to a temporary file, so an interrupted download does not leave a truncated file
+        with open(f"{filename}.part", "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        os.replace(f"{filename}.part", filename)
+        with open(validators_file, "w") as f:
+            json.dump(
+                {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}, f
+            )
+    return True
 
 
 def download_dict(dict_name) -> str:
-    print(f"Downloading {dict_name}")
+    """Download the zip of a dictionary (or its TSV if there is no valid zip), returns the path of the file."""
     ddl_dir = "data/pubdict"
     os.makedirs(ddl_dir, exist_ok=True)
 
-    zip_url = f"https://pubdictionaries.org/dictionaries/{dict_name}/downloadable"
+    zip_url = f"{pubdict_url}/dictionaries/{dict_name}/downloadable"
     zip_filename = f"{ddl_dir}/{dict_name}.zip"
 
     try:
         # Try to download the zipped file
-        zip_response = requests.get(zip_url)
-        zip_response.raise_for_status()
-
-        # Save the zip file locally
-        with open(zip_filename, "wb") as f:
-            f.write(zip_response.content)
-        print(f"Downloaded {dict_name}.zip")
-
-        # Unzipping the content
-        with zipfile.ZipFile(zip_filename, "r") as z:
-            z.extractall(ddl_dir)
-        print(f"Unzipped {dict_name}")
-        # NOTE: inside the zip file the dict in a .csv, but the content is TSV
-        return f"{ddl_dir}/{dict_name}.csv"
+        if fetch(zip_url, zip_filename):
+            print(f"Downloaded {dict_name}.zip")
+        else:
+            print(f"{dict_name}.zip not modified since the last download")
+        if not zipfile.is_zipfile(zip_filename):
+            raise zipfile.BadZipFile(f"{zip_filename} is not a zip file")
+        return zip_filename
 
     except (requests.exceptions.HTTPError, zipfile.BadZipFile) as e:
         try:
             # If the zipped file download fails, fallback to TSV download
             print(f"{e} for {dict_name}, downloading TSV file instead")
-            tsv_url = f"https://pubdictionaries.org/dictionaries/{dict_name}.tsv?mode=3"
+            tsv_url = f"{pubdict_url}/dictionaries/{dict_name}.tsv?mode=3"
             tsv_filename = f"{ddl_dir}/{dict_name}.tsv"
-
-            tsv_response = requests.get(tsv_url)
-            tsv_response.raise_for_status()
-            with open(tsv_filename, "wb") as f:
-                f.write(tsv_response.content)
-            print(f"Downloaded {tsv_filename}")
+            if fetch(tsv_url, tsv_filename):
+                print(f"Downloaded {tsv_filename}")
             return tsv_filename
-        except:
+        except Exception:
             print(
                 f"Error downloading {dict_name} (probably timeout, because bad zipfile)"
             )
             bad_zipfiles.append(dict_name)
             return ""
+    except Exception as e:
+        print(f"Error downloading {dict_name}: {e}")
+        bad_zipfiles.append(dict_name)
+        return ""
+
+
+def read_dict(filename: str) -> Iterator[pd.DataFrame]:
+    """Read chunks of rows of a dictionary, directly from the member of the zip file without extracting it."""
+    if not filename.endswith(".zip"):
+        yield from pd.read_csv(filename, sep="\t", chunksize=chunk_size)
+        return
+    with zipfile.ZipFile(filename) as z:
+        # NOTE: inside the zip file the dict in a .csv, but the content is TSV
+        member = next((name for name in z.namelist() if name.endswith(".csv")), z.namelist()[0])
+        with z.open(member) as f:
+            yield from pd.read_csv(f, sep="\t", chunksize=chunk_size)
+
+
+def load_dictionary(backend: PgvectorBackend, dict_name: str, filename: str) -> int:
+    """Embed the labels of a downloaded dictionary and COPY them in the table, returns the number of rows loaded."""
+    if not filename:
+        return 0
+
+    # NOTE: fastembed fails when embedding some dictionaries such as SNOMEDCT or Regulation_new_3
+    # Probably we need to escape some chars but it's not mentioned in their doc
+    #   File "/usr/local/lib/python3.11/site-packages/fastembed/embedding.py", line 116, in onnx_embed
+    #     encoded = self.tokenizer.encode_batch(documents)
+    #             ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+    # TypeError: TextEncodeInput must be Union[TextInputSequence, Tuple[InputSequence, InputSequence]]
+
+    rows = 0
+    # The labels of an ID can be spread over the chunks, the centroids are uploaded once the dictionary is read
+    centroids = CentroidAccumulator()
+    start_time = time.time()
+    for df in tqdm(read_dict(filename), desc=f"Processing {dict_name}"):
+        labels = df["#label"].tolist()
+        ids = df["id"].tolist()
+        try:
+            start = time.time()
+            embeddings = embed_model.embed(labels)
+            embed_timer.add(len(labels), time.time() - start)
+            start = time.time()
+            backend.upsert(
+                [point_id(dict_name, str(label_id), str(label)) for label_id, label in zip(ids, labels)],
+                embeddings,
+                [
+                    {"curie": label_id, "embedded_label": label, "source": dict_name}
+                    for label_id, label in zip(ids, labels)
+                ],
+            )
+            centroids.add(
+                [str(label_id) for label_id in ids],
+                embeddings,
+                [{"curie": str(label_id), "source": dict_name} for label_id in ids],
+            )
+            upsert_timer.add(len(labels), time.time() - start)
+            rows += len(labels)
+        except Exception as e:
+            print(f"Error generating embeddings for {dict_name}: {e}")
+            error_gen_embeddings.append(dict_name)
+
+    if len(centroids):
+        backend.upsert_centroids(*centroids.flush())
+
+    time_taken = time.time() - start_time
+    print(f"Loaded {rows} rows of {dict_name} in {time_taken:.1f}s ({rows / max(time_taken, 1e-9):.0f} rows/s)")
+    return rows
 
 
 if __name__ == "__main__":
@@ -115,69 +195,37 @@ if __name__ == "__main__":
     dict_names = ["HP-PA"]
 
     reset_table = False
+    # Number of dictionaries downloaded at the same time
+    download_concurrency = 8
+    # Number of dictionaries loaded in parallel, each with its own connection from the pool
+    parallel_dicts = 4
+    # Drop the indexes during the load and build them once at the end, which is faster than updating them on each COPY
+    defer_indexes = True
 
     # https://github.com/pgvector/pgvector-python
-    with psycopg.connect(pg_connect) as conn:
-        with conn.cursor() as cursor:
-            conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
-            register_vector(conn)
-
-            # Create a table with a vector column if it doesn't already exist
-            cursor.execute(
-                f"""
-            CREATE TABLE IF NOT EXISTS pubdictionaries_embeddings (
-                label_id TEXT,
-                label TEXT,
-                dictionary TEXT,
-                embedding vector({embed_model.embedding_size})
-            )
-            """
-            )
-            conn.commit()
-
-            # Truncate the table to clean it before inserting new data
-            if reset_table:
-                cursor.execute("TRUNCATE TABLE pubdictionaries_embeddings")
-                conn.commit()
-
-            for dict_name in dict_names:
-                filename = download_dict(dict_name)
-                if not filename:
-                    continue
-
-                # NOTE: fastembed fails when embedding some dictionaries such as SNOMEDCT or Regulation_new_3
-                # Probably we need to escape some chars but it's not mentioned in their doc
-                #   File "/usr/local/lib/python3.11/site-packages/fastembed/embedding.py", line 116, in onnx_embed
-                #     encoded = self.tokenizer.encode_batch(documents)
-                #             ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
-                # TypeError: TextEncodeInput must be Union[TextInputSequence, Tuple[InputSequence, InputSequence]]
-
-                for df in tqdm(
-                    pd.read_csv(filename, sep="\t", chunksize=chunk_size),
-                    desc=f"Processing {dict_name}",
-                ):
-                    labels = df["#label"].tolist()
-                    ids = df["id"].tolist()
-                    # print(labels)
-                    # print(ids)
-                    try:
-                        embeddings = embed_model.embed(labels)
-
-                        for label_id, label, embedding in zip(ids, labels, embeddings):
-                            cursor.execute(
-                                "INSERT INTO pubdictionaries_embeddings (label_id, label, dictionary, embedding) VALUES (%s, %s, %s, %s)",
-                                (
-                                    label_id,
-                                    label,
-                                    dict_name,
-                                    embedding,
-                                ),
-                            )
-
-                        conn.commit()
-                    except Exception as e:
-                        print(f"Error generating embeddings for {dict_name}: {e}")
-                        error_gen_embeddings.append(dict_name)
+    backend = PgvectorBackend(conninfo=pg_connect, table="pubdictionaries_embeddings", max_connections=parallel_dicts)
+    # Create the table with a vector column if it doesn't already exist, and truncate it if reset_table
+    backend.create(embed_model.embedding_size, recreate=reset_table, defer_indexes=defer_indexes)
+
+    start_time = time.time()
+    # Dictionaries are downloaded ahead of the loading, which waits for each download in order
+    with ThreadPoolExecutor(max_workers=download_concurrency) as downloader, ThreadPoolExecutor(
+        max_workers=parallel_dicts
+    ) as executor:
+        downloads = {dict_name: downloader.submit(download_dict, dict_name) for dict_name in dict_names}
+        rows_count = sum(
+            executor.map(lambda dict_name: load_dictionary(backend, dict_name, downloads[dict_name].result()), dict_names)
+        )
+    time_taken = time.time() - start_time
+    print(f"Loaded {rows_count} rows in {time_taken:.1f}s ({rows_count / max(time_taken, 1e-9):.0f} rows/s)")
+    print(embed_timer.report())
+    print(upsert_timer.report(parallel_dicts))
+
+    # Build the ANN index once all dictionaries are loaded, instead of updating it on every insert
+    start_time = time.time()
+    backend.build_indexes()
+    print(f"Indexes built in {time.time() - start_time:.1f}s")
+    backend.close()
 
     print(
         f"There was an error when generating embeddings for the following dictionaries: {error_gen_embeddings}"
@@ -1,29 +1,29 @@
+import asyncio
 import os
-import pandas as pd
-import numpy as np
-from fastembed.embedding import FlagEmbedding as Embedding
-import psycopg
-from pgvector.psycopg import register_vector
+import sys
 
-from src.pubdict_load import embed_model
+import numpy as np
 
-search = "sensory loss"
+from src.backends import PG_CONNECT, PgvectorBackend, SearchFilters, VectorQuery
+from src.embeddings import embed
 
-embeddings = embed_model.embed([search])
+# Usage: python src/pubdict_search.py "sensory loss" [DICTIONARY ...]
+search = sys.argv[1] if len(sys.argv) > 1 else "sensory loss"
+dictionaries = sys.argv[2:]
 
-pg_connect = "dbname=postgres user=postgres password=password host=db"
-with psycopg.connect(pg_connect) as conn:
-    with conn.cursor() as cursor:
-        register_vector(conn)
+embeddings = embed([search])
 
-        similars = conn.execute(
-            "SELECT embedding <-> %s AS distance, * FROM pubdictionaries_embeddings ORDER BY distance LIMIT 50",
-            (np.array(embeddings[0]),),
-        ).fetchall()
-        # all = conn.execute("SELECT * FROM pubdictionaries_embeddings LIMIT 5").fetchall()
+# Cosine distance on the HNSW index, set PG_HNSW_EF_SEARCH to trade speed for recall
+backend = PgvectorBackend(
+    conninfo=PG_CONNECT,
+    table="pubdictionaries_embeddings",
+    ef_search=int(os.environ["PG_HNSW_EF_SEARCH"]) if os.getenv("PG_HNSW_EF_SEARCH") else None,
+)
+query = VectorQuery(np.array(embeddings[0]), filters=SearchFilters(sources=dictionaries) if dictionaries else None)
+similars = asyncio.run(backend.search_hits([query], [50]))[0]
 
-        for sim in similars:
-            print(f"{sim[2]} - {sim[3]} - {sim[0]} - {sim[1]}")
+for sim in similars:
+    print(f"{sim.label} - {sim.payload['source']} - {sim.score} - {sim.curie}")
 
 
 # TODO: add to ruby? https://github.com/ankane/neighbor#getting-started
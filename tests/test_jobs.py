@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from src.jobs import JobStore
+
+
+async def upload(content: bytes):
+    # Chunks cut in the middle of the lines, like the body of a request
+    for start in range(0, len(content), 7):
+        yield content[start : start + 7]
+
+
+def run_job(tmp_path, content: bytes, resolve, file_format: str = "tsv"):
+    """Create and run a job, returns its status, the results streamed and the labels resolved by each call."""
+    calls = []
+
+    async def resolve_batch(labels, params):
+        calls.append(labels)
+        return [resolve(label) for label in labels]
+
+    async def main():
+        store = JobStore(str(tmp_path), resolve_batch, batch_size=2)
+        store.queue = asyncio.Queue()
+        status = await store.create(upload(content), file_format, {"limit": 1})
+        await store.run(status["id"])
+        streamed = b"".join([chunk async for chunk in store.stream_results(status["id"])])
+        return store.get(status["id"]), streamed
+
+    status, streamed = asyncio.run(main())
+    return status, streamed, calls
+
+
+def test_job_resolves_repeated_labels_once(tmp_path):
+    status, streamed, calls = run_job(
+        tmp_path, b"fever\nFever \n\nheadache\nfever", lambda label: [{"curie": f"HP:{label}"}]
+    )
+
+    assert calls == [["fever"], ["headache"]]
+    counts = ("status", "lines_total", "lines_done", "labels_resolved", "labels_reused")
+    assert {key: status[key] for key in counts} == {
+        "status": "done",
+        "lines_total": 5,
+        "lines_done": 5,
+        "labels_resolved": 2,
+        "labels_reused": 2,
+    }
+    assert [json.loads(line) for line in streamed.splitlines()] == [
+        {"line": 1, "string": "fever", "results": [{"curie": "HP:fever"}]},
+        {"line": 2, "string": "Fever ", "results": [{"curie": "HP:fever"}]},
+        {"line": 3, "string": "", "results": []},
+        {"line": 4, "string": "headache", "results": [{"curie": "HP:headache"}]},
+        {"line": 5, "string": "fever", "results": [{"curie": "HP:fever"}]},
+    ]
+
+
+def test_job_streams_lines_longer_than_a_chunk(tmp_path):
+    # Each result line is more than the 1 MB chunks the results are read by
+    status, streamed, _ = run_job(
+        tmp_path, b'"fever"\n"headache"\n', lambda label: [{"curie": "HP:1", "synonyms": [label * 300000]}], "jsonl"
+    )
+
+    assert status["status"] == "done"
+    lines = streamed.splitlines()
+    assert all(len(line) > 1024 * 1024 for line in lines)
+    assert [json.loads(line)["results"][0]["synonyms"][0] for line in lines] == ["fever" * 300000, "headache" * 300000]
+    with open(tmp_path / status["id"] / "results.ndjson", "rb") as f:
+        assert streamed == f.read()
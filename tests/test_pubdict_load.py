@@ -0,0 +1,110 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import pubdict_load
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "pubdict")
+
+
+def fixture_bytes(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+class PubDictHandler(BaseHTTPRequestHandler):
+    """Serve the fixture dictionaries like PubDictionaries: `mini` has a zip, `notzip` answers its zip URL with
+    an HTML page, and `missing` has no zip, the 2 last ones only have their TSV."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/dictionaries/mini/downloadable":
+            self.send_file(fixture_bytes("mini.zip"), etag='"mini-zip-v1"')
+        elif self.path == "/dictionaries/notzip/downloadable":
+            self.send_file(b"<html>Generating the dictionary, try again later</html>", etag='"notzip-html"')
+        elif self.path in ("/dictionaries/notzip.tsv?mode=3", "/dictionaries/missing.tsv?mode=3"):
+            self.send_file(fixture_bytes("mini.tsv"), etag='"tsv-v1"')
+        else:
+            self.send_error(404)
+
+    def send_file(self, content: bytes, etag: str):
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pubdict_server(tmp_path, monkeypatch):
+    """Local PubDictionaries server, with the dictionaries downloaded to a temporary directory."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PubDictHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(pubdict_load, "pubdict_url", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.chdir(tmp_path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_skips_not_modified_dict(pubdict_server):
+    assert pubdict_load.download_dict("mini") == "data/pubdict/mini.zip"
+    assert pubdict_server.requests[-1][1].get("If-None-Match") is None
+    modified_time = os.path.getmtime("data/pubdict/mini.zip")
+
+    assert pubdict_load.download_dict("mini") == "data/pubdict/mini.zip"
+    # The ETag of the first download is sent back, and the server answers 304 without content
+    assert pubdict_server.requests[-1][1]["If-None-Match"] == '"mini-zip-v1"'
+    assert len(pubdict_server.requests) == 2
+    assert os.path.getmtime("data/pubdict/mini.zip") == modified_time
+    with open("data/pubdict/mini.zip", "rb") as f:
+        assert f.read() == fixture_bytes("mini.zip")
+    assert not os.path.exists("data/pubdict/mini.zip.part")
+
+
+@pytest.mark.parametrize("dict_name", ["notzip", "missing"])
+def test_download_falls_back_to_tsv(pubdict_server, dict_name):
+    assert pubdict_load.download_dict(dict_name) == f"data/pubdict/{dict_name}.tsv"
+    assert [path for path, _ in pubdict_server.requests] == [
+        f"/dictionaries/{dict_name}/downloadable",
+        f"/dictionaries/{dict_name}.tsv?mode=3",
+    ]
+    with open(f"data/pubdict/{dict_name}.tsv", "rb") as f:
+        assert f.read() == fixture_bytes("mini.tsv")
+    assert dict_name not in pubdict_load.bad_zipfiles
+
+
+def test_download_unknown_dict(pubdict_server):
+    assert pubdict_load.download_dict("unknown") == ""
+    assert "unknown" in pubdict_load.bad_zipfiles
+
+
+def test_read_dict_streams_zip_member(pubdict_server, monkeypatch):
+    monkeypatch.setattr(pubdict_load, "chunk_size", 2)
+    zip_chunks = list(pubdict_load.read_dict(pubdict_load.download_dict("mini")))
+    tsv_chunks = list(pubdict_load.read_dict(pubdict_load.download_dict("missing")))
+
+    assert [len(df) for df in zip_chunks] == [2, 2, 1]
+    assert [row for df in zip_chunks for row in df[["#label", "id"]].values.tolist()] == [
+        row for df in tsv_chunks for row in df[["#label", "id"]].values.tolist()
+    ]
+    assert zip_chunks[0]["#label"].tolist() == ["headache", "fever"]
+    assert zip_chunks[-1]["id"].tolist() == ["HP:0001250"]
+    # The zip is read in place, its member is not extracted next to it
+    assert sorted(os.listdir("data/pubdict")) == [
+        "mini.zip",
+        "mini.zip.headers.json",
+        "missing.tsv",
+        "missing.tsv.headers.json",
+    ]